@@ -3,8 +3,12 @@ from .config import settings
 from .database import init_db, get_db, SessionLocal
 from .models import Base, User, Device, Message, ServerConfig
 from .auth import hash_password, generate_token, validate_api_token, validate_device_token
+from .auth_cache import (
+    get_api_user, peek_api_user, get_owned_device, peek_owned_device,
+    invalidate_api_token, invalidate_device
+)
 from .utils import is_device_online, get_dynamic_base_url, get_stored_base_url, update_base_url
-from .cleanup import cleanup_old_messages, start_cleanup_thread
+from .cleanup import cleanup_old_messages, start_cleanup_task
 
 # Create logger, but do NOT configure basicConfig
 logger = logging.getLogger("wakelink_cloud")
@@ -14,6 +18,8 @@ __all__ = [
     'init_db', 'get_db', 'SessionLocal',
     'Base', 'User', 'Device', 'Message', 'ServerConfig',
     'hash_password', 'generate_token', 'validate_api_token', 'validate_device_token',
+    'get_api_user', 'peek_api_user', 'get_owned_device', 'peek_owned_device',
+    'invalidate_api_token', 'invalidate_device',
     'is_device_online', 'get_dynamic_base_url', 'get_stored_base_url', 'update_base_url',
-    'cleanup_old_messages', 'start_cleanup_thread', 'logger'
+    'cleanup_old_messages', 'start_cleanup_task', 'logger'
 ]
\ No newline at end of file
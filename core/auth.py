@@ -1,24 +1,86 @@
+import asyncio
 import hashlib
+import hmac
+import os
 import secrets
+from concurrent.futures import ThreadPoolExecutor
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
+from datetime import datetime
 from fastapi import HTTPException, status
+from sqlalchemy import bindparam, func, case, delete, select
+from sqlalchemy.engine import Row
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import Session
 from typing import Optional, Tuple, Dict, Any
 
 from .models import User, Device
 
-def hash_password(password: str) -> str:
-    """Password hashing SHA-256"""
-    return hashlib.sha256(password.encode()).hexdigest()
+# Argon2id with per-user random salt, stored as a single PHC string
+_ph = PasswordHasher(time_cost=3, memory_cost=64 * 1024, parallelism=1)
 
-def generate_token(length: int = 32) -> str:
-    """Generate secure token"""
-    return secrets.token_hex(length)
+# Argon2 hashing and verification take tens of ms of CPU; run them off the
+# event loop. argon2-cffi releases the GIL while hashing, so threads run in
+# parallel without the pickling and fork cost of a process pool.
+pw_executor = ThreadPoolExecutor(max_workers=min(os.cpu_count() or 1, 4), thread_name_prefix="pw")
+# Caps in-flight hashes so a login/register flood queues instead of piling onto the pool
+MAX_CONCURRENT_PASSWORD_CHECKS = 8
+_pw_semaphore: Optional[asyncio.Semaphore] = None
 
-def validate_api_token(db: Session, api_token: str) -> Optional[User]:
-    return db.query(User).filter(User.api_token == api_token).first()
+# Verified against for unknown usernames so both failure paths cost one hash
+_DUMMY_HASH = _ph.hash(secrets.token_urlsafe(16))
 
-def validate_device_token(db: Session, device_token: str) -> Optional[Device]:
-    return db.query(Device).filter(Device.device_token == device_token).first()
+def hash_password(password: str) -> str:
+    """Password hashing Argon2id"""
+    return _ph.hash(password)
+
+def _is_legacy_hash(password_hash: str) -> bool:
+    """Unsalted SHA-256 hex digests from before the Argon2id migration"""
+    return len(password_hash) == 64 and not password_hash.startswith("$")
+
+def verify_password(password_hash: str, password: str) -> bool:
+    """Check password against a stored Argon2id (or legacy SHA-256) hash"""
+    if _is_legacy_hash(password_hash):
+        legacy = hashlib.sha256(password.encode()).hexdigest()
+        return hmac.compare_digest(password_hash, legacy)
+    try:
+        return _ph.verify(password_hash, password)
+    except (VerificationError, InvalidHashError):
+        return False
+
+def password_needs_rehash(password_hash: str) -> bool:
+    """True for legacy hashes and Argon2 hashes with outdated parameters"""
+    return _is_legacy_hash(password_hash) or _ph.check_needs_rehash(password_hash)
+
+def generate_token(nbytes: int = 24) -> str:
+    """Generate secure URL-safe token from nbytes of randomness (24 -> 32 chars)"""
+    return secrets.token_urlsafe(nbytes)
+
+# Token lookups are built once at import; each call only binds the token
+_API_TOKEN_STMT = (
+    select(User.id, User.username, User.plan, User.devices_limit, User.api_token)
+    .where(User.api_token == bindparam("t"))
+)
+_DEVICE_TOKEN_STMT = (
+    select(Device.device_id, Device.user_id, Device.device_token)
+    .where(Device.device_token == bindparam("t"))
+)
+_OWNED_DEVICE_STMT = (
+    select(Device.device_id, Device.user_id, Device.device_token)
+    .where(Device.device_id == bindparam("d"), Device.user_id == bindparam("u"))
+)
+
+def validate_api_token(db: Session, api_token: str) -> Optional[Row]:
+    """Look up columns of the token's user (read-only row, not an ORM object)"""
+    return db.execute(_API_TOKEN_STMT, {"t": api_token}).first()
+
+def validate_device_token(db: Session, device_token: str) -> Optional[Row]:
+    """Look up columns of the token's device (read-only row, not an ORM object)"""
+    return db.execute(_DEVICE_TOKEN_STMT, {"t": device_token}).first()
+
+def validate_device_owner(db: Session, device_id: str, user_id: int) -> Optional[Row]:
+    """Look up columns of device_id if user_id owns it (read-only row)"""
+    return db.execute(_OWNED_DEVICE_STMT, {"d": device_id, "u": user_id}).first()
 
 def create_user(db: Session, user_data) -> Tuple[Optional[User], Optional[str]]:
     """Create user"""
@@ -39,74 +101,119 @@ def create_user(db: Session, user_data) -> Tuple[Optional[User], Optional[str]]:
 
 def authenticate_user(db: Session, login_data) -> Optional[User]:
     """User authentication"""
-    password_hash = hash_password(login_data.password)
-    return db.query(User).filter(
-        User.username == login_data.username,
-        User.password_hash == password_hash
-    ).first()
+    # Lookup by the indexed username only; the hash is compared in Python,
+    # not in SQL. The full User row is loaded, since a rehash updates it
+    user = db.execute(
+        select(User).where(User.username == login_data.username)
+    ).scalar_one_or_none()
+    if not user or not user.password_hash:
+        verify_password(_DUMMY_HASH, login_data.password)
+        return None
+    if not verify_password(user.password_hash, login_data.password):
+        return None
+
+    # Transparently upgrade legacy or outdated hashes on successful login
+    if password_needs_rehash(user.password_hash):
+        user.password_hash = hash_password(login_data.password)
+        db.commit()
+    return user
+
+def _get_pw_semaphore() -> asyncio.Semaphore:
+    """Create the semaphore on first use so it binds to the running loop"""
+    global _pw_semaphore
+    if _pw_semaphore is None:
+        _pw_semaphore = asyncio.Semaphore(MAX_CONCURRENT_PASSWORD_CHECKS)
+    return _pw_semaphore
+
+async def authenticate_user_async(db: Session, login_data) -> Optional[User]:
+    """User authentication in pw_executor, so hashing never blocks the event loop"""
+    async with _get_pw_semaphore():
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(pw_executor, authenticate_user, db, login_data)
+
+async def create_user_async(db: Session, user_data) -> Tuple[Optional[User], Optional[str]]:
+    """User creation in pw_executor, so hashing never blocks the event loop"""
+    async with _get_pw_semaphore():
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(pw_executor, create_user, db, user_data)
 
 def save_device(db: Session, user_id: int, device_id: str, device_data: Dict[str, Any]) -> Device:
     """Register or update device"""
-    from datetime import datetime
-    
-    # Check limit
-    device_count = db.query(Device).filter(Device.user_id == user_id).count()
-    user = db.query(User).filter(User.id == user_id).first()
-    if user and device_count >= user.devices_limit:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail=f"Device limit: maximum {user.devices_limit}"
-        )
+    from .auth_cache import invalidate_device
+
+    # Check limit: devices limit, device count and whether device_id is
+    # already registered to this user, all in one query
+    row = db.query(
+        User.devices_limit,
+        func.count(Device.device_id),
+        func.count(case((Device.device_id == device_id, 1)))
+    ).outerjoin(Device, Device.user_id == User.id).filter(User.id == user_id).group_by(User.id).first()
+    if row:
+        devices_limit, device_count, already_registered = row
+        if not already_registered and device_count >= devices_limit:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail=f"Device limit: maximum {devices_limit}"
+            )
 
     device_token = device_data.get('device_token') or generate_token(16)
     cloud = True
     now = datetime.now().astimezone()
 
-    # Check for existing device
-    existing = db.query(Device).filter(
-        Device.device_id == device_id,
-        Device.user_id == user_id
-    ).first()
-
-    if existing:
-        existing.device_token = device_token
-        existing.cloud = cloud
-        existing.last_seen = now
-        device = existing
-    else:
-        device = Device(
-            device_id=device_id,
-            user_id=user_id,
-            device_token=device_token,
-            cloud=cloud,
-            added=now,
-            last_seen=now
+    # Insert, or update the existing row if this user already owns it
+    stmt = sqlite_insert(Device).values(
+        device_id=device_id,
+        user_id=user_id,
+        device_token=device_token,
+        cloud=cloud,
+        added=now,
+        last_seen=now,
+        last_seen_ts=int(now.timestamp())
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Device.device_id],
+        set_={
+            'device_token': stmt.excluded.device_token,
+            'cloud': stmt.excluded.cloud,
+            'last_seen': stmt.excluded.last_seen,
+            'last_seen_ts': stmt.excluded.last_seen_ts
+        },
+        where=(Device.user_id == user_id)
+    ).returning(Device)
+
+    device = db.scalars(stmt, execution_options={"populate_existing": True}).first()
+    if device is None:
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Device {device_id} is registered to another user"
         )
-        db.add(device)
 
+    # Keep loaded attributes usable after commit without a refresh query
+    db.expunge(device)
     db.commit()
-    db.refresh(device)
+    invalidate_device(device_id)
     return device
 
 def delete_device(db: Session, api_token: str, device_id: str) -> Tuple[bool, str]:
     """Delete device by device_id"""
-    from .models import Message
+    from .auth_cache import invalidate_device
 
     user = validate_api_token(db, api_token)
     if not user:
         return False, "Invalid API token"
 
-    device = db.query(Device).filter(
-        Device.device_id == device_id,
-        Device.user_id == user.id
-    ).first()
+    # Device messages are removed by ON DELETE CASCADE
+    result = db.execute(
+        delete(Device).where(
+            Device.device_id == device_id,
+            Device.user_id == user.id
+        )
+    )
+    db.commit()
 
-    if not device:
+    if not result.rowcount:
         return False, "Device not found or access denied"
 
-    # Delete all device messages
-    db.query(Message).filter(Message.device_id == device_id).delete()
-    db.delete(device)
-    db.commit()
-
-    return True, f"Device {device_id} deleted"
\ No newline at end of file
+    invalidate_device(device_id)
+    return True, f"Device {device_id} deleted"
@@ -0,0 +1,99 @@
+"""In-process TTL cache for API token and device ownership lookups.
+
+Token validation runs on every authenticated request against a table that
+rarely changes. The cache stores lightweight tuples rather than ORM
+instances, so cached values are never bound to (or detached from) a
+Session. Callers that need to mutate a row load it themselves by id.
+"""
+
+import threading
+from typing import NamedTuple, Optional
+
+from cachetools import TTLCache
+from sqlalchemy.orm import Session
+
+from .auth import validate_api_token, validate_device_owner
+
+TOKEN_CACHE_SIZE = 10_000
+TOKEN_CACHE_TTL = 60  # seconds
+
+
+class CachedUser(NamedTuple):
+    """Columns of User needed by authenticated endpoints."""
+    id: int
+    username: str
+    plan: str
+    devices_limit: int
+    api_token: str
+
+
+class CachedDevice(NamedTuple):
+    """Columns of Device needed to authenticate a device WebSocket."""
+    device_id: str
+    user_id: int
+    device_token: str
+
+
+_user_cache: TTLCache = TTLCache(maxsize=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL)
+# device_id -> CachedDevice, for WebSocket connects that authenticate by
+# API token + device_id (device_id is the primary key, so one owner)
+_owner_cache: TTLCache = TTLCache(maxsize=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL)
+# Sync dependencies run in the threadpool, TTLCache itself is not thread-safe
+_lock = threading.Lock()
+
+
+def peek_api_user(api_token: str) -> Optional[CachedUser]:
+    """Return the cached user for a token without touching the DB."""
+    with _lock:
+        return _user_cache.get(api_token)
+
+
+def get_api_user(db: Session, api_token: str) -> Optional[CachedUser]:
+    """Resolve an API token to a CachedUser, hitting the DB only on a miss."""
+    cached = peek_api_user(api_token)
+    if cached is not None:
+        return cached
+
+    user = validate_api_token(db, api_token)
+    if not user:
+        return None
+    cached = CachedUser(user.id, user.username, user.plan, user.devices_limit, user.api_token)
+    with _lock:
+        _user_cache[api_token] = cached
+    return cached
+
+
+def peek_owned_device(device_id: str, user_id: int) -> Optional[CachedDevice]:
+    """Return the cached device if user_id owns it, without touching the DB."""
+    with _lock:
+        cached = _owner_cache.get(device_id)
+    if cached is not None and cached.user_id == user_id:
+        return cached
+    return None
+
+
+def get_owned_device(db: Session, device_id: str, user_id: int) -> Optional[CachedDevice]:
+    """Resolve device_id owned by user_id, hitting the DB only on a miss."""
+    cached = peek_owned_device(device_id, user_id)
+    if cached is not None:
+        return cached
+
+    device = validate_device_owner(db, device_id, user_id)
+    if not device:
+        return None
+    cached = CachedDevice(device.device_id, device.user_id, device.device_token)
+    with _lock:
+        _owner_cache[device_id] = cached
+    return cached
+
+
+def invalidate_api_token(api_token: str) -> None:
+    """Drop a user's cached token (token rotation, user deletion)."""
+    with _lock:
+        _user_cache.pop(api_token, None)
+
+
+def invalidate_device(device_id: str) -> None:
+    """Drop a device's cached ownership entry (deletion, token change)."""
+    with _lock:
+        _owner_cache.pop(device_id, None)
@@ -1,33 +1,48 @@
-import time
-import threading
+import asyncio
 from datetime import datetime, timedelta
-from sqlalchemy.orm import Session
+from sqlalchemy import bindparam, delete
+from sqlalchemy.engine import Connection
 
 from .config import settings
-from .database import SessionLocal
+from .database import engine
 from .models import Message
 
-def cleanup_old_messages():
+# Built once at import; each tick only binds the cutoff
+_CLEANUP_STMT = delete(Message).where(Message.timestamp < bindparam("cut"))
+
+def _delete_expired_messages(conn: Connection) -> int:
+    """Delete messages older than MESSAGE_RETENTION_MINUTES, return count"""
+    cutoff_time = datetime.now().astimezone() - timedelta(minutes=settings.MESSAGE_RETENTION_MINUTES)
+    try:
+        result = conn.execute(_CLEANUP_STMT, {"cut": cutoff_time})
+        conn.commit()
+        return result.rowcount
+    except Exception:
+        conn.rollback()
+        raise
+
+async def cleanup_old_messages():
     """Background task: delete messages older than MESSAGE_RETENTION_MINUTES"""
-    while True:
-        time.sleep(60)
-        db = SessionLocal()
-        try:
-            cutoff_time = datetime.now().astimezone() - timedelta(minutes=settings.MESSAGE_RETENTION_MINUTES)
-            deleted = db.query(Message).filter(Message.timestamp < cutoff_time).delete()
-            db.commit()
-            if deleted > 0:
-                from . import logger
-                logger.info(f"Cleaned {deleted} old messages")
-        except Exception as e:
-            from . import logger
-            logger.error(f"Error cleaning messages: {e}")
-        finally:
-            db.close()
+    from . import logger
+    loop = asyncio.get_running_loop()
+    # One connection for the loop's lifetime keeps its SQLite page cache warm
+    conn = engine.connect()
+    try:
+        while True:
+            await asyncio.sleep(60)
+            try:
+                # Blocking SQLite DELETE runs in the default executor
+                deleted = await loop.run_in_executor(None, _delete_expired_messages, conn)
+                if deleted > 0:
+                    logger.info(f"Cleaned {deleted} old messages")
+            except Exception as e:
+                logger.error(f"Error cleaning messages: {e}")
+    finally:
+        conn.close()
 
-def start_cleanup_thread():
-    """Start background message cleanup"""
-    thread = threading.Thread(target=cleanup_old_messages, daemon=True)
-    thread.start()
+def start_cleanup_task() -> asyncio.Task:
+    """Start background message cleanup on the running event loop"""
+    task = asyncio.create_task(cleanup_old_messages())
     from . import logger
-    logger.info("Background message cleanup started")
\ No newline at end of file
+    logger.info("Background message cleanup started")
+    return task
@@ -18,6 +18,17 @@ class Settings:
     
     # Cleanup settings
     MESSAGE_RETENTION_MINUTES: int = int(os.getenv("MESSAGE_RETENTION_MINUTES", "5"))
+
+    # Relay settings (in-memory queue per offline device, oldest dropped first)
+    QUEUE_MAX_MESSAGES: int = int(os.getenv("QUEUE_MAX_MESSAGES", "100"))
+    QUEUE_MAX_BYTES: int = int(os.getenv("QUEUE_MAX_BYTES", str(256 * 1024)))
+    # Long-poll safety re-check, for pushes handled by another worker process
+    PULL_RECHECK_SECONDS: float = float(os.getenv("PULL_RECHECK_SECONDS", "1.0"))
+
+    # WebSocket read-side limits: largest accepted frame, and frames buffered
+    # per connection before the server stops reading (TCP backpressure)
+    WS_MAX_MESSAGE_BYTES: int = int(os.getenv("WS_MAX_MESSAGE_BYTES", str(256 * 1024)))
+    WS_MAX_QUEUE: int = int(os.getenv("WS_MAX_QUEUE", "16"))
     
     # Other settings
     DEBUG: bool = os.getenv("DEBUG", "False").lower() == "true"
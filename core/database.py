@@ -1,7 +1,9 @@
 import logging
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker, Session
-from typing import Generator
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool, StaticPool
+from typing import AsyncGenerator, Generator
 
 from .config import settings
 from .models import Base
@@ -9,9 +11,120 @@ from .models import Base
 logger = logging.getLogger("wakelink_cloud")
 
 # Database setup
-SQLALCHEMY_DATABASE_URL = f"sqlite:///{settings.DATABASE_FILE}"
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+if settings.DATABASE_FILE == ":memory:":
+    # Shared-cache in-memory database, so the sync and async engines see the same data
+    _DATABASE_PATH = "file:wakelink_cloud?mode=memory&cache=shared&uri=true"
+else:
+    _DATABASE_PATH = settings.DATABASE_FILE
+SQLALCHEMY_DATABASE_URL = f"sqlite:///{_DATABASE_PATH}"
+ASYNC_DATABASE_URL = f"sqlite+aiosqlite:///{_DATABASE_PATH}"
+
+if settings.DATABASE_FILE == ":memory:":
+    # In-memory database lives only while a connection is open, keep one per engine
+    engine = create_engine(
+        SQLALCHEMY_DATABASE_URL,
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool
+    )
+    async_engine = create_async_engine(ASYNC_DATABASE_URL, poolclass=StaticPool)
+else:
+    engine = create_engine(
+        SQLALCHEMY_DATABASE_URL,
+        connect_args={"check_same_thread": False},
+        poolclass=QueuePool,
+        pool_size=5,
+        max_overflow=10,
+        pool_pre_ping=True
+    )
+    # Async engine for the /api routes, so DB calls never block the event loop
+    # Explicit pool class: SQLAlchemy < 2.0.38 defaults aiosqlite files to
+    # NullPool, which rejects pool_size/max_overflow
+    async_engine = create_async_engine(
+        ASYNC_DATABASE_URL,
+        poolclass=AsyncAdaptedQueuePool,
+        pool_size=20,
+        max_overflow=10,
+        pool_pre_ping=True,
+        pool_recycle=3600
+    )
+
+# Per-connection SQLite tuning: WAL lets readers run alongside the writer,
+# synchronous=NORMAL drops the fsync from every commit (still durable in WAL)
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",      # 64 MiB page cache
+    "PRAGMA mmap_size=268435456",    # 256 MiB memory-mapped I/O
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA foreign_keys=ON",        # Required for ON DELETE CASCADE
+)
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+        for pragma in SQLITE_PRAGMAS:
+            cursor.execute(pragma)
+    finally:
+        cursor.close()
+
+event.listen(engine, "connect", _set_sqlite_pragmas)
+event.listen(async_engine.sync_engine, "connect", _set_sqlite_pragmas)
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# expire_on_commit=False: attribute access after commit must not trigger lazy IO
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+def _upgrade_messages_foreign_key():
+    """Recreate a pre-cascade messages table.
+
+    With foreign_keys=ON, the old FK without ON DELETE CASCADE would block
+    device deletion. Messages are a short-lived relay queue (see
+    MESSAGE_RETENTION_MINUTES), so the table is rebuilt empty instead of
+    copying rows.
+    """
+    from .models import Message
+    with engine.connect() as conn:
+        # Rows: (id, seq, table, from, to, on_update, on_delete, match)
+        foreign_keys = conn.exec_driver_sql("PRAGMA foreign_key_list(messages)").fetchall()
+    if not any(fk[3] == "device_token" and fk[6].upper() != "CASCADE" for fk in foreign_keys):
+        return
+    Message.__table__.drop(bind=engine)
+    Message.__table__.create(bind=engine)
+    logger.info("Recreated messages table with ON DELETE CASCADE")
+
+def _add_missing_columns():
+    """Add nullable columns declared on models to tables from older versions."""
+    from sqlalchemy import inspect
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing or not column.nullable:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                conn.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}')
+                logger.info(f"Added column {table.name}.{column.name}")
+
+# Indexes from older versions now covered by another index
+STALE_INDEXES = (
+    "ix_messages_device_id",  # prefix of ix_msg_dev_dir_ts
+    "ix_msg_dev_ts",          # replaced by ix_msg_dev_dir_ts
+    "ix_devices_device_id",   # duplicates the devices primary key index
+)
+
+def _drop_stale_indexes():
+    """Drop superseded indexes, so writes stop maintaining them."""
+    with engine.begin() as conn:
+        for name in STALE_INDEXES:
+            conn.exec_driver_sql(f"DROP INDEX IF EXISTS {name}")
+
+def _create_missing_indexes():
+    """Add indexes declared on models to tables created by older versions."""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
 
 def init_db():
     """Create tables and initialize base_url."""
@@ -20,6 +133,12 @@ def init_db():
         Base.metadata.create_all(bind=engine)
         logger.info("All database tables created")
 
+        # create_all() does not alter tables that already exist
+        _upgrade_messages_foreign_key()
+        _add_missing_columns()
+        _create_missing_indexes()
+        _drop_stale_indexes()
+
         # Initialize base_url
         from .models import ServerConfig
         db = SessionLocal()
@@ -47,4 +166,8 @@ def get_db() -> Generator[Session, None, None]:
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+async def get_async_db() -> AsyncGenerator[AsyncSession, None]:
+    async with AsyncSessionLocal() as db:
+        yield db
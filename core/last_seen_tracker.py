@@ -0,0 +1,180 @@
+"""Write-behind buffer for device last_seen, poll_count and request counters.
+
+Every push, pull and WebSocket packet marks its device as seen. Committing
+that UPDATE per request turns a polling fleet into a constant stream of
+single-row writes, so the tracker keeps the latest timestamp, pending poll
+increments and last request_counter per device in memory and writes them
+with one executemany UPDATE each every FLUSH_INTERVAL seconds.
+
+Online checks use a 5 minute window, so a few seconds of lag is invisible.
+Only str device ids are buffered, and a failed batch is retried per
+device, so one bad entry cannot discard the other devices' updates.
+The hot path only records time.time(); the local timezone is resolved
+once per flush and each device's datetime is built directly in it.
+"""
+
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Dict, Optional
+
+from sqlalchemy import bindparam, update
+
+from .database import engine
+from .models import Device
+
+logger = logging.getLogger("wakelink_cloud")
+
+FLUSH_INTERVAL = 2.0  # seconds
+
+# SQLite INTEGER is a signed 64-bit value
+_INT64_MIN = -(1 << 63)
+_INT64_MAX = (1 << 63) - 1
+
+
+def is_valid_request_counter(value) -> bool:
+    """True for an int (not bool) that fits Device.last_request_counter."""
+    return type(value) is int and _INT64_MIN <= value <= _INT64_MAX
+
+# Built once at import; bind names must differ from column names in UPDATE
+_SEEN_STMT = (
+    update(Device)
+    .where(Device.device_id == bindparam("b_device_id"))
+    .values(last_seen=bindparam("b_last_seen"), last_seen_ts=bindparam("b_last_seen_ts"))
+)
+_POLLS_STMT = (
+    update(Device)
+    .where(Device.device_id == bindparam("b_device_id"))
+    .values(poll_count=Device.poll_count + bindparam("b_polls"))
+)
+_COUNTER_STMT = (
+    update(Device)
+    .where(Device.device_id == bindparam("b_device_id"))
+    .values(last_request_counter=bindparam("b_counter"))
+)
+
+
+def _write_updates(seen: Dict[str, float], polls: Dict[str, int],
+                   counters: Dict[str, int]) -> None:
+    """Apply buffered updates in one transaction."""
+    with engine.begin() as conn:
+        if seen:
+            # One tz lookup per flush (not cached at import, so DST changes apply)
+            local_tz = datetime.now().astimezone().tzinfo
+            conn.execute(_SEEN_STMT, [
+                {
+                    "b_device_id": device_id,
+                    "b_last_seen": datetime.fromtimestamp(ts, local_tz),
+                    "b_last_seen_ts": int(ts)
+                }
+                for device_id, ts in seen.items()
+            ])
+        if polls:
+            conn.execute(_POLLS_STMT, [
+                {"b_device_id": device_id, "b_polls": n}
+                for device_id, n in polls.items()
+            ])
+        if counters:
+            conn.execute(_COUNTER_STMT, [
+                {"b_device_id": device_id, "b_counter": counter}
+                for device_id, counter in counters.items()
+            ])
+
+
+def _write_each(seen: Dict[str, float], polls: Dict[str, int],
+                counters: Dict[str, int]) -> int:
+    """Apply updates one device per transaction after a failed batch.
+
+    Returns the number of devices whose updates had to be dropped.
+    """
+    failed = 0
+    for device_id in seen.keys() | polls.keys() | counters.keys():
+        try:
+            _write_updates(
+                {device_id: seen[device_id]} if device_id in seen else {},
+                {device_id: polls[device_id]} if device_id in polls else {},
+                {device_id: counters[device_id]} if device_id in counters else {}
+            )
+        except Exception as e:
+            logger.error(f"Dropped last_seen update for device {device_id!r}: {e}")
+            failed += 1
+    return failed
+
+
+class LastSeenTracker:
+    """Coalesces last_seen, poll_count and request_counter writes per device.
+
+    Attributes:
+        _seen: device_id -> most recent epoch time the device was seen.
+        _polls: device_id -> poll_count increments not yet written.
+        _counters: device_id -> latest request_counter reported over WebSocket.
+        _task: Background flush loop.
+    """
+
+    def __init__(self):
+        self._seen: Dict[str, float] = {}
+        self._polls: Dict[str, int] = {}
+        self._counters: Dict[str, int] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def touch(self, device_id: str, now: Optional[float] = None):
+        """Record that device_id was seen (epoch seconds, default now)."""
+        if isinstance(device_id, str):
+            self._seen[device_id] = now or time.time()
+
+    def add_poll(self, device_id: str):
+        """Count one message-bearing poll for device_id."""
+        if isinstance(device_id, str):
+            self._polls[device_id] = self._polls.get(device_id, 0) + 1
+
+    def set_request_counter(self, device_id: str, counter: int) -> bool:
+        """Record the latest request_counter a device reported.
+
+        Values that are not 64-bit ints are ignored (returns False), so one
+        device's malformed frame can never reach the shared batch UPDATE.
+        """
+        if not isinstance(device_id, str) or not is_valid_request_counter(counter):
+            return False
+        self._counters[device_id] = counter
+        return True
+
+    async def flush(self):
+        """Write all buffered updates."""
+        if not self._seen and not self._polls and not self._counters:
+            return
+        seen, self._seen = self._seen, {}
+        polls, self._polls = self._polls, {}
+        counters, self._counters = self._counters, {}
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, _write_updates, seen, polls, counters)
+        except Exception as e:
+            logger.error(f"Failed to write last_seen for {len(seen)} devices, retrying per device: {e}")
+            await loop.run_in_executor(None, _write_each, seen, polls, counters)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            await self.flush()
+
+    def start(self) -> asyncio.Task:
+        """Start the background flush loop on the running event loop."""
+        self._task = asyncio.create_task(self._run())
+        logger.info("Last-seen write-behind buffer started")
+        return self._task
+
+    async def stop(self):
+        """Cancel the flush loop and write whatever is still buffered."""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+# Global instance
+last_seen_tracker = LastSeenTracker()
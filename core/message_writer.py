@@ -0,0 +1,162 @@
+"""Batched persistence of relayed messages for WakeLink Cloud Server.
+
+When a WebSocket peer is offline, relayed packets are stored in the
+messages table for HTTP polling. Writing them one ORM object and one
+commit at a time is dominated by unit-of-work overhead, so the writer
+buffers rows and flushes them with a single executemany INSERT every
+FLUSH_INTERVAL seconds, or as soon as BATCH_SIZE rows are pending.
+HTTP long-pollers waiting on a written device/direction are woken once
+their rows are committed. Each row's device_token is filled in by the
+INSERT itself, so callers never look the device up.
+
+Callers on the WebSocket receive path only append to an in-memory list;
+the disk write and fsync happen in the executor. The buffer is bounded by
+MAX_PENDING so a stalled database cannot grow it without limit.
+"""
+
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+from sqlalchemy import bindparam, insert, select
+
+from .database import SessionLocal
+from .models import Device, Message
+from .relay import relay
+
+logger = logging.getLogger("wakelink_cloud")
+
+BATCH_SIZE = 100
+FLUSH_INTERVAL = 0.05  # seconds
+MAX_PENDING = 10_000  # oldest rows are dropped beyond this
+
+
+# Built once at import; device_token is resolved per row by a scalar subquery
+# (NULL for unregistered devices), bind names differ from column names
+_INSERT_STMT = insert(Message).values(
+    device_id=bindparam("b_device_id"),
+    device_token=select(Device.device_token)
+    .where(Device.device_id == bindparam("b_device_id"))
+    .scalar_subquery(),
+    message_type=bindparam("b_message_type"),
+    message_data=bindparam("b_message_data"),
+    signature=bindparam("b_signature"),
+    direction=bindparam("b_direction")
+)
+
+
+def _insert_rows(rows: List[Dict[str, Any]]) -> None:
+    """Insert rows into messages in one executemany statement."""
+    db = SessionLocal()
+    try:
+        db.execute(_INSERT_STMT, rows)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def _insert_each(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Insert rows one statement each after a failed batch, return the stored ones.
+
+    One bad row must not take the other devices' queued messages with it.
+    """
+    stored = []
+    for row in rows:
+        try:
+            _insert_rows([row])
+        except Exception as e:
+            logger.error(f"Dropped message for device {row['b_device_id']!r}: {e}")
+            continue
+        stored.append(row)
+    return stored
+
+
+class MessageWriter:
+    """Buffers Message rows and writes them in batches.
+
+    Attributes:
+        _pending: Rows waiting for the next flush; a bounded deque, so
+            evicting the oldest row when full is O(1).
+        _dropped: Rows discarded since the last flush because the buffer
+            was full.
+        _batch_full: Set when BATCH_SIZE rows are pending (created on start,
+            so it binds to the running event loop).
+        _task: Background flush loop.
+    """
+
+    def __init__(self):
+        self._pending: Deque[Dict[str, Any]] = deque(maxlen=MAX_PENDING)
+        self._dropped = 0
+        self._batch_full: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def add(self, device_id: str, message_type: str, message_data: str,
+            signature: str, direction: str):
+        """Queue a message row for the next batch insert (never blocks)."""
+        if len(self._pending) == MAX_PENDING:
+            # Same policy as the relay's offline queue: the append below
+            # evicts the oldest row; count it for the next flush's warning
+            self._dropped += 1
+        self._pending.append({
+            "b_device_id": device_id,
+            "b_message_type": message_type,
+            "b_message_data": message_data,
+            "b_signature": signature,
+            "b_direction": direction,
+        })
+        if len(self._pending) >= BATCH_SIZE and self._batch_full is not None:
+            self._batch_full.set()
+
+    async def flush(self):
+        """Write all pending rows, BATCH_SIZE rows per statement."""
+        if self._dropped:
+            logger.warning(f"Message buffer full, dropped {self._dropped} oldest messages")
+            self._dropped = 0
+        loop = asyncio.get_running_loop()
+        pending = self._pending
+        # Take one batch at a time: if the loop is cancelled mid-flush (shutdown),
+        # rows not yet handed to the executor stay buffered for stop()'s flush
+        while pending:
+            batch = [pending.popleft() for _ in range(min(BATCH_SIZE, len(pending)))]
+            try:
+                await loop.run_in_executor(None, _insert_rows, batch)
+            except Exception as e:
+                logger.error(f"Failed to persist {len(batch)} messages, retrying one by one: {e}")
+                batch = await loop.run_in_executor(None, _insert_each, batch)
+            for device_id, direction in {(r["b_device_id"], r["b_direction"]) for r in batch}:
+                relay.notify_pull(device_id, direction)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._batch_full.wait(), timeout=FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._batch_full.clear()
+            await self.flush()
+
+    def start(self) -> asyncio.Task:
+        """Start the background flush loop on the running event loop."""
+        self._batch_full = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        logger.info("Batched message writer started")
+        return self._task
+
+    async def stop(self):
+        """Cancel the flush loop and write whatever is still pending."""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+# Global instance
+message_writer = MessageWriter()
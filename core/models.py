@@ -1,5 +1,6 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text, Index
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from datetime import datetime, timezone
 
@@ -11,33 +12,48 @@ class User(Base):
     id = Column(Integer, primary_key=True, index=True)
     username = Column(String, unique=True, index=True)
     password_hash = Column(String)
-    api_token = Column(String, unique=True, index=True)
+    # 32-char token_urlsafe tokens; legacy 64-char hex tokens stay valid
+    api_token = Column(String(64), unique=True, index=True)
     plan = Column(String, default='base')
     devices_limit = Column(Integer, default=5)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
+    # Lazy by default; list views opt in with selectinload(User.devices)
+    devices = relationship("Device", back_populates="user")
+
 class Device(Base):
     __tablename__ = "devices"
     
-    device_id = Column(String, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey('users.id'))
-    device_token = Column(String, unique=True, index=True)
+    # The primary key's implicit unique index (sqlite_autoindex_devices_1)
+    # already serves device_id lookups; a second index only slows writes
+    device_id = Column(String, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), index=True)  # Per-user device lists and limits
+    device_token = Column(String(64), unique=True, index=True)
     cloud = Column(Boolean, default=True)
     added = Column(DateTime(timezone=True))
     last_seen = Column(DateTime(timezone=True))
+    last_seen_ts = Column(Integer)  # Epoch seconds mirror of last_seen for online checks
     poll_count = Column(Integer, default=0)
     last_request_counter = Column(Integer, default=0)
 
+    user = relationship("User", back_populates="devices")
+
 class Message(Base):
     __tablename__ = "messages"
     id = Column(Integer, primary_key=True)
-    device_token = Column(String, ForeignKey('devices.device_token'))
-    device_id = Column(String, index=True)
+    # Queued messages go away with their device (SQLite needs PRAGMA foreign_keys=ON)
+    device_token = Column(String, ForeignKey('devices.device_token', ondelete='CASCADE', onupdate='CASCADE'))
+    device_id = Column(String)  # Indexed by ix_msg_dev_dir_ts
     message_type = Column(String, default="command")
     message_data = Column(Text)
     signature = Column(String, nullable=True)  # Added for storing HMAC signature
     direction = Column(String)  # "to_device" | "to_client"
-    timestamp = Column(DateTime(timezone=True), server_default=func.now())
+    timestamp = Column(DateTime(timezone=True), server_default=func.now(), index=True)
+
+    __table_args__ = (
+        # Pull's DELETE ... WHERE device_id=? AND direction=?, oldest first
+        Index('ix_msg_dev_dir_ts', 'device_id', 'direction', 'timestamp'),
+    )
 
 class ServerConfig(Base):
     __tablename__ = "server_config"
@@ -8,38 +8,88 @@ Key concepts:
 - Clients connect to /ws/client/{client_id}
 - When client sends command to device, relay tracks the pending response
 - When device responds, relay forwards to the waiting client
+- HTTP long-pollers (/api/pull) wait on a per (device_id, direction) event
+  that /api/push sets, instead of re-querying the database
 """
 
+from collections import deque
 from fastapi import WebSocket
-from typing import Dict, List, Any, Optional
+from typing import Deque, Dict, List, Optional, Set, Tuple, Union
 import asyncio
 import logging
-import json
+import orjson
+
+from .config import settings
 
 logger = logging.getLogger("wakelink_cloud")
 
+# Number of striped locks; operations on distinct connection ids rarely share one
+LOCK_STRIPES = 64
+
+Frame = Union[dict, str]
+
+
+def encode_frame(data: Frame) -> str:
+    """Serialize an outer packet to JSON text once.
+
+    Already encoded frames are returned unchanged, so callers can encode at
+    ingress and every delivery attempt or queued retry reuses the result.
+    Text (not binary) frames are kept for firmware compatibility.
+    """
+    if isinstance(data, str):
+        return data
+    return orjson.dumps(data).decode()
+
 
 class WebSocketManager:
     """Manages WebSocket connections and message relay for WakeLink.
 
     This class handles:
     - Active WebSocket connections for devices and clients
-    - Message queuing for offline devices
+    - Message queuing for offline devices, bounded by QUEUE_MAX_MESSAGES
+      and QUEUE_MAX_BYTES per device (oldest frames are dropped first)
     - Response routing from devices back to clients
-    - Thread-safe operations using asyncio.Lock
+    - Per-connection_id serialization using striped asyncio.Lock objects
 
     Attributes:
         connections: Dict mapping connection_id to WebSocket.
-        queues: Dict mapping device_id to pending messages.
+        connection_count: Number of open connections (devices and clients),
+            maintained in connect/disconnect and read as a plain attribute.
+        device_connection_count: Number of connected devices (connections
+            that are not client_*), kept in step with connections so stats
+            need not scan it.
+        queues: Dict mapping device_id to pending pre-encoded frames.
+        queue_bytes: Dict mapping device_id to the size of its queued frames.
         pending_responses: Dict mapping device_id to client_id waiting for response.
-        _lock: Asyncio lock for thread-safe access.
+        client_to_devices: Reverse index of pending_responses (client_id to
+            device_ids), so a client disconnect touches only its own entries.
+        pull_events: Dict mapping (device_id, direction) to the asyncio.Event
+            that HTTP long-pollers wait on. Created on first wait, popped
+            and set on notify, so each push wakes the current waiters once.
+        pull_waiters: Dict mapping (device_id, direction) to the number of
+            long-pollers currently registered; the last one to leave drops
+            the key from both dicts, so entries never outlive their waiters.
+        _locks: Striped asyncio locks, picked by hash of the connection_id.
+            Single dict get/set needs no lock on the event loop; the locks
+            only keep read-modify-write sequences on one id from interleaving
+            across awaits.
     """
 
     def __init__(self):
         self.connections: Dict[str, WebSocket] = {}  # connection_id -> WebSocket
-        self.queues: Dict[str, List[Any]] = {}  # device_id -> pending messages
+        self.connection_count = 0  # len of connections
+        self.device_connection_count = 0  # len of connections minus client_* ids
+        self.queues: Dict[str, Deque[str]] = {}  # device_id -> pending encoded frames
+        self.queue_bytes: Dict[str, int] = {}  # device_id -> total queued frame size
         self.pending_responses: Dict[str, str] = {}  # device_id -> client_id waiting
-        self._lock = asyncio.Lock()
+        self.client_to_devices: Dict[str, Set[str]] = {}  # client_id -> device_ids awaited
+        self.pull_events: Dict[Tuple[str, str], asyncio.Event] = {}  # (device_id, direction) -> event
+        self.pull_waiters: Dict[Tuple[str, str], int] = {}  # (device_id, direction) -> waiter count
+        self._locks = [asyncio.Lock() for _ in range(LOCK_STRIPES)]
+
+    def _lock_for(self, connection_id: str) -> asyncio.Lock:
+        """Return the stripe lock guarding this connection_id."""
+        return self._locks[hash(connection_id) % LOCK_STRIPES]
 
     async def connect(self, ws: WebSocket, connection_id: str, already_accepted: bool = True):
         """Register a new WebSocket connection.
@@ -51,21 +101,27 @@ class WebSocketManager:
         """
         if not already_accepted:
             await ws.accept()
-        async with self._lock:
+        lock = self._lock_for(connection_id)
+        async with lock:
+            if connection_id not in self.connections:
+                self.connection_count += 1
+                if not connection_id.startswith("client_"):
+                    self.device_connection_count += 1
             self.connections[connection_id] = ws
-            queued = self.queues.get(connection_id, [])
+            queued = self.queues.get(connection_id, ())
 
         # Deliver any queued messages
         if queued:
             logger.info(f"Delivering {len(queued)} queued messages to {connection_id}")
             for msg in queued:
                 try:
-                    await ws.send_text(json.dumps(msg))
+                    await ws.send_text(msg)
                 except Exception:
                     logger.exception("Failed to send queued message")
                     break
-            async with self._lock:
+            async with lock:
                 self.queues.pop(connection_id, None)
+                self.queue_bytes.pop(connection_id, None)
 
         logger.info(f"WebSocket connected: {connection_id}")
 
@@ -75,13 +131,18 @@ class WebSocketManager:
         Args:
             connection_id: The connection identifier.
         """
-        async with self._lock:
+        async with self._lock_for(connection_id):
             ws = self.connections.pop(connection_id, None)
-            # Clean up any pending response associations
-            for device_id, client_id in list(self.pending_responses.items()):
-                if client_id == connection_id:
-                    del self.pending_responses[device_id]
-        
+            if ws is not None:
+                self.connection_count -= 1
+                if not connection_id.startswith("client_"):
+                    self.device_connection_count -= 1
+
+        # Clean up this client's pending response associations (no await, so atomic)
+        for device_id in self.client_to_devices.pop(connection_id, ()):
+            if self.pending_responses.get(device_id) == connection_id:
+                del self.pending_responses[device_id]
+
         if ws:
             try:
                 await ws.close()
@@ -89,43 +150,69 @@ class WebSocketManager:
                 pass
         logger.info(f"WebSocket disconnected: {connection_id}")
 
-    async def push(self, target_id: str, data: dict, sender_id: Optional[str] = None) -> bool:
+    async def push(self, target_id: str, data: Frame, sender_id: Optional[str] = None) -> bool:
         """Send data to a connected device/client.
 
         If target is connected, sends immediately. Otherwise queues for later.
 
         Args:
             target_id: Target device_id or client_id.
-            data: The message data (outer JSON packet).
+            data: The outer JSON packet, as a dict or already encoded text.
             sender_id: Optional sender connection_id for response tracking.
 
         Returns:
             bool: True if delivered immediately, False if queued.
         """
-        async with self._lock:
+        frame = encode_frame(data)
+        lock = self._lock_for(target_id)
+        async with lock:
             ws = self.connections.get(target_id)
             
             # Track pending response if client is waiting for device
             if sender_id and sender_id.startswith("client_"):
+                previous = self.pending_responses.get(target_id)
+                if previous and previous != sender_id:
+                    self._forget_pending(previous, target_id)
                 self.pending_responses[target_id] = sender_id
+                self.client_to_devices.setdefault(sender_id, set()).add(target_id)
                 logger.debug(f"Tracking response: {target_id} -> {sender_id}")
 
         if ws:
             try:
-                await ws.send_text(json.dumps(data))
+                await ws.send_text(frame)
                 logger.info(f"Pushed message to {target_id}")
                 return True
             except Exception:
                 logger.exception(f"Failed to push to {target_id}, queuing")
 
         # Queue if delivery failed
-        async with self._lock:
-            q = self.queues.setdefault(target_id, [])
-            q.append(data)
+        async with lock:
+            dropped = self._enqueue(target_id, frame)
+        if dropped:
+            logger.warning(f"Queue for {target_id} full, dropped {dropped} oldest messages")
         logger.info(f"Message queued for {target_id}")
         return False
 
-    async def push_response(self, device_id: str, data: dict) -> bool:
+    def _enqueue(self, target_id: str, frame: str) -> int:
+        """Append a frame to target's queue, evicting the oldest over limits.
+
+        Returns:
+            int: Number of frames dropped to stay within the limits.
+        """
+        q = self.queues.get(target_id)
+        if q is None:
+            q = self.queues[target_id] = deque()
+        size = self.queue_bytes.get(target_id, 0) + len(frame)
+        q.append(frame)
+
+        dropped = 0
+        while len(q) > 1 and (len(q) > settings.QUEUE_MAX_MESSAGES or size > settings.QUEUE_MAX_BYTES):
+            size -= len(q.popleft())
+            dropped += 1
+        self.queue_bytes[target_id] = size
+        return dropped
+
+    async def push_response(self, device_id: str, data: Frame) -> bool:
         """Forward device response to the waiting client.
 
         When a device sends a response, this finds the client that
@@ -133,24 +220,25 @@ class WebSocketManager:
 
         Args:
             device_id: The device that sent the response.
-            data: The response packet.
+            data: The response packet, as a dict or already encoded text.
 
         Returns:
             bool: True if forwarded to client, False otherwise.
         """
-        async with self._lock:
+        async with self._lock_for(device_id):
             client_id = self.pending_responses.pop(device_id, None)
+            if client_id:
+                self._forget_pending(client_id, device_id)
 
         if not client_id:
             logger.debug(f"No client waiting for response from {device_id}")
             return False
 
-        async with self._lock:
-            ws = self.connections.get(client_id)
+        ws = self.connections.get(client_id)
 
         if ws:
             try:
-                await ws.send_text(json.dumps(data))
+                await ws.send_text(encode_frame(data))
                 logger.info(f"Forwarded response from {device_id} to {client_id}")
                 return True
             except Exception:
@@ -158,6 +246,44 @@ class WebSocketManager:
 
         return False
 
+    def _forget_pending(self, client_id: str, device_id: str):
+        """Remove device_id from a client's reverse index entry."""
+        devices = self.client_to_devices.get(client_id)
+        if devices is not None:
+            devices.discard(device_id)
+            if not devices:
+                del self.client_to_devices[client_id]
+
+    def pull_event(self, device_id: str, direction: str) -> asyncio.Event:
+        """Register a long-poller for (device_id, direction), return its event.
+
+        Fetch it before querying for messages, so a push landing between
+        the query and the wait still wakes the poller. Every call must be
+        paired with release_pull_event(), also when the wait times out.
+        """
+        key = (device_id, direction)
+        self.pull_waiters[key] = self.pull_waiters.get(key, 0) + 1
+        event = self.pull_events.get(key)
+        if event is None:
+            event = self.pull_events[key] = asyncio.Event()
+        return event
+
+    def release_pull_event(self, device_id: str, direction: str):
+        """Unregister a long-poller; the last one removes the entry."""
+        key = (device_id, direction)
+        remaining = self.pull_waiters.get(key, 0) - 1
+        if remaining > 0:
+            self.pull_waiters[key] = remaining
+        else:
+            self.pull_waiters.pop(key, None)
+            self.pull_events.pop(key, None)
+
+    def notify_pull(self, device_id: str, direction: str):
+        """Wake long-pollers waiting for messages on (device_id, direction)."""
+        event = self.pull_events.pop((device_id, direction), None)
+        if event is not None:
+            event.set()
+
     def get_connected_devices(self) -> List[str]:
         """Get list of connected device IDs (excluding clients)."""
         return [k for k in self.connections.keys() if not k.startswith("client_")]
@@ -1,4 +1,4 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 from typing import List, Optional, Dict, Any
 from datetime import datetime
 
@@ -20,6 +20,8 @@ class DeleteDeviceRequest(BaseModel):
     device_id: str
 
 class DeviceInfo(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
     device_id: str
     cloud: bool
     online: bool
@@ -45,17 +47,23 @@ class PullRequest(BaseModel):
     wait: Optional[int] = 0  # Long polling: wait up to N seconds for messages (0 = immediate)
 
 class PullResponse(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
     messages: List[Dict[str, str]]
     count: int
 
 # API responses
 class DeviceRegisteredResponse(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
     status: str
     device_id: str
     device_token: str
     mode: str
 
 class UserDevicesResponse(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
     user: str
     plan: str
     devices_limit: int
@@ -63,6 +71,8 @@ class UserDevicesResponse(BaseModel):
     devices: List[DeviceInfo]
 
 class MessageResponse(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
     status: str
     device_id: str
     delivered_via_ws: bool = False
@@ -0,0 +1,24 @@
+"""Shared Jinja2 templates for WakeLink Cloud Server.
+
+Every route module renders through this single Environment, so compiled
+templates are cached once per process instead of once per router.
+"""
+
+from fastapi.templating import Jinja2Templates
+from jinja2 import Environment, FileSystemLoader
+
+from .config import settings
+
+# Templates never change in production: no mtime stat per render, compiled
+# templates kept for the process lifetime (same autoescape as Starlette's default).
+# DEBUG keeps hot reload for template editing.
+templates = Jinja2Templates(env=Environment(
+    loader=FileSystemLoader("templates"),
+    autoescape=True,
+    auto_reload=settings.DEBUG,
+    cache_size=-1
+))
+
+# Compile at import, so with preload_app workers inherit them from the master
+for _name in templates.env.list_templates(extensions=["html"]):
+    templates.get_template(_name)
@@ -1,13 +1,28 @@
-from datetime import datetime, timedelta
-from typing import Optional
+import threading
+import time
+from cachetools import TTLCache
+from datetime import datetime
+from typing import Container, Dict, Iterable, Optional
 from fastapi import Request
+from sqlalchemy import case, func, or_, select
 from sqlalchemy.orm import Session
 
 from .config import settings
-from .models import ServerConfig
+from .models import Device, Message, ServerConfig, User
 from .relay import relay
 
-def is_device_online(last_seen: Optional[datetime], device_id: Optional[str] = None) -> bool:
+# A polling device counts as online for this long after its last request
+ONLINE_WINDOW_SECONDS = 5 * 60
+
+# Server-wide stats are display-only; this much staleness is acceptable
+SYSTEM_STATS_CACHE_TTL = 10
+_system_stats_cache: TTLCache = TTLCache(maxsize=1, ttl=SYSTEM_STATS_CACHE_TTL)
+# Readers run both on the event loop and in the threadpool
+_system_stats_lock = threading.Lock()
+
+def is_device_online(last_seen_ts: Optional[int], device_id: Optional[str] = None,
+                     now_ts: Optional[int] = None,
+                     connected: Optional[Container[str]] = None) -> bool:
     """Check if device is online.
     
     A device is considered online if:
@@ -15,31 +30,89 @@ def is_device_online(last_seen: Optional[datetime], device_id: Optional[str] = N
     2. It was seen within the last 5 minutes (HTTP polling)
     
     Args:
-        last_seen: Last seen timestamp from database.
+        last_seen_ts: Device.last_seen_ts epoch seconds from database.
         device_id: Optional device ID to check WSS connection.
+        now_ts: Optional current epoch seconds, so list views can compute
+            it once for all rows.
+        connected: Optional container of connected ids (e.g. relay.connections)
+            bound once by list views instead of a relay method call per row.
     
     Returns:
         True if device is online, False otherwise.
     """
     # Check if device has active WSS connection
-    if device_id and relay.is_connected(device_id):
-        return True
+    if device_id:
+        if connected is None:
+            connected = relay.connections
+        if device_id in connected:
+            return True
     
     # Fallback to last_seen check (HTTP polling)
-    if not last_seen:
-        return False
-    try:
-        now = datetime.now().astimezone()
-        # Handle timezone-naive last_seen by assuming UTC
-        if last_seen.tzinfo is None:
-            from datetime import timezone
-            last_seen = last_seen.replace(tzinfo=timezone.utc)
-        
-        diff = now - last_seen
-        return diff < timedelta(minutes=5)
-    except Exception as e:
-        print(f"[ONLINE CHECK] Error: {e}, last_seen={last_seen}")
+    if not last_seen_ts:
         return False
+    if now_ts is None:
+        now_ts = int(time.time())
+    return now_ts - last_seen_ts < ONLINE_WINDOW_SECONDS
+
+def get_system_stats(db: Session, wss_connected: Iterable[str] = ()) -> Dict[str, int]:
+    """Server-wide counters with conditional aggregation, in two queries.
+    
+    Args:
+        db: Database session.
+        wss_connected: Device IDs with an active WSS connection; these count
+            as online even if their last HTTP poll is older than 5 minutes.
+    
+    Returns:
+        Dict with online_devices, total_devices, total_users,
+        queues_to_device and queues_to_client.
+    """
+    online = Device.last_seen_ts > int(time.time()) - ONLINE_WINDOW_SECONDS
+    wss_connected = list(wss_connected)
+    if wss_connected:
+        online = or_(online, Device.device_id.in_(wss_connected))
+
+    total_devices, online_devices, total_users = db.execute(
+        select(
+            func.count(Device.device_id),
+            func.count(case((online, 1))),
+            select(func.count(User.id)).scalar_subquery()
+        ).select_from(Device)
+    ).one()
+    queues_to_device, queues_to_client = db.execute(
+        select(
+            func.count(case((Message.direction == 'to_device', 1))),
+            func.count(case((Message.direction == 'to_client', 1)))
+        )
+    ).one()
+
+    return {
+        "online_devices": online_devices,
+        "total_devices": total_devices,
+        "total_users": total_users,
+        "queues_to_device": queues_to_device,
+        "queues_to_client": queues_to_client,
+    }
+
+def peek_system_stats() -> Optional[Dict[str, int]]:
+    """Return cached system stats, or None if the cache has expired."""
+    with _system_stats_lock:
+        return _system_stats_cache.get("system_stats")
+
+def get_cached_system_stats(db: Session) -> Dict[str, int]:
+    """get_system_stats() cached for SYSTEM_STATS_CACHE_TTL seconds.
+
+    The first caller in a window runs the two count queries (and lists the
+    WSS-connected devices); the rest get the cached dict, which also holds
+    wss_connections. Callers must not mutate it.
+    """
+    stats = peek_system_stats()
+    if stats is None:
+        wss_connected = relay.get_connected_devices()
+        stats = get_system_stats(db, wss_connected)
+        stats["wss_connections"] = relay.device_connection_count  # Active device WebSocket connections
+        with _system_stats_lock:
+            _system_stats_cache["system_stats"] = stats
+    return stats
 
 def get_dynamic_base_url(request: Request) -> str:
     """Dynamically determines full base_url with protocol"""
@@ -49,8 +122,10 @@ def get_dynamic_base_url(request: Request) -> str:
 
 def get_stored_base_url(db: Session) -> str:
     """Gets base_url from database"""
-    config = db.query(ServerConfig).filter(ServerConfig.key == 'base_url').first()
-    return config.value if config else f"http://localhost:{settings.CLOUD_PORT}"
+    value = db.execute(
+        select(ServerConfig.value).where(ServerConfig.key == 'base_url')
+    ).scalar()
+    return value if value is not None else f"http://localhost:{settings.CLOUD_PORT}"
 
 def update_base_url(db: Session, new_url: str) -> bool:
     """Updates base_url in database"""
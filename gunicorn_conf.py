@@ -1,21 +1,39 @@
 import multiprocessing
+import os
+from uvicorn.workers import UvicornWorker
 from core.config import settings
 
+
+class WakeLinkUvicornWorker(UvicornWorker):
+    """Uvicorn worker with the same WebSocket read limits as main.py"""
+    CONFIG_KWARGS = {
+        **UvicornWorker.CONFIG_KWARGS,
+        "ws_max_size": settings.WS_MAX_MESSAGE_BYTES,
+        "ws_max_queue": settings.WS_MAX_QUEUE,
+    }
+
+
 # Socket binding
 bind = f"0.0.0.0:{settings.CLOUD_PORT}"
 
-# Worker processes (optimal for I/O bound applications)
-workers = multiprocessing.cpu_count() * 2
+# Worker processes: one event loop per core for ASGI (cpu*2 is the sync WSGI rule)
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
 
-# Use uvicorn workers for ASGI
-worker_class = "uvicorn.workers.UvicornWorker"
+# Use uvicorn workers for ASGI (gunicorn accepts the class object itself)
+worker_class = WakeLinkUvicornWorker
 
 # Performance settings
 worker_connections = 1000
 max_requests = 1000
 max_requests_jitter = 100
 timeout = 120
-keepalive = 5
+keepalive = 30  # ESP polling clients reuse the TCP connection between polls
+
+# Keep worker heartbeat files in RAM instead of on disk
+worker_tmp_dir = "/dev/shm"
+
+# Import the app once in the master; workers share its pages copy-on-write
+preload_app = True
 
 # WebSocket settings for ESP compatibility
 # Note: These are passed to uvicorn worker via environment
@@ -32,4 +50,11 @@ limit_request_fields = 100
 limit_request_field_size = 8190
 
 # Process naming
-proc_name = "wakelink_cloud_server"
\ No newline at end of file
+proc_name = "wakelink_cloud_server"
+
+
+def post_fork(server, worker):
+    """Drop pooled DB connections inherited from the preloaded master."""
+    from core.database import engine, async_engine
+    engine.dispose(close=False)
+    async_engine.sync_engine.dispose(close=False)
\ No newline at end of file
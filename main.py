@@ -13,15 +13,19 @@ Version: 1.0
 License: NGC License
 """
 
+import asyncio
 import logging
 import sys
 import uvicorn
 from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 
-from core import init_db, start_cleanup_thread, settings, logger
+from core import init_db, start_cleanup_task, settings, logger
+from core.last_seen_tracker import last_seen_tracker
+from core.message_writer import message_writer
 from routes.api import router as api_router
 from routes.wss import router as wss_router
 from routes.home import router as home_router
@@ -46,7 +50,8 @@ def setup_logging() -> None:
 async def lifespan(app: FastAPI):
     """Application lifespan handler.
     
-    Initializes database and starts background cleanup thread on startup.
+    Initializes database and starts background cleanup, batched message
+    writer and last_seen write-behind tasks on startup, stops them on shutdown.
     
     Args:
         app: The FastAPI application instance.
@@ -60,7 +65,9 @@ async def lifespan(app: FastAPI):
     logger.info(f"Database: {settings.DATABASE_FILE}")
     
     # Start background cleanup
-    start_cleanup_thread()
+    cleanup_task = start_cleanup_task()
+    message_writer.start()
+    last_seen_tracker.start()
     
     logger.info(f"Server Port: {settings.CLOUD_PORT}")
     logger.info(f"Debug Mode: {settings.DEBUG}")
@@ -69,6 +76,13 @@ async def lifespan(app: FastAPI):
     yield
     
     logger.info("WakeLink Cloud Server Shutting Down")
+    cleanup_task.cancel()
+    try:
+        await cleanup_task
+    except asyncio.CancelledError:
+        pass
+    await message_writer.stop()
+    await last_seen_tracker.stop()
 
 
 # Create FastAPI application
@@ -77,6 +91,7 @@ app = FastAPI(
     description="Secure relay server for WakeLink Protocol v1.0",
     version="1.0.0",
     lifespan=lifespan,
+    default_response_class=ORJSONResponse,
     docs_url="/docs",
     redoc_url="/redoc"
 )
@@ -110,7 +125,11 @@ if __name__ == "__main__":
         port=settings.CLOUD_PORT,
         reload=settings.DEBUG,
         log_level="debug" if settings.DEBUG else "info",
+        # Default loop/http "auto" select uvloop and httptools when installed
         # WebSocket settings for ESP compatibility
         ws_ping_interval=30,  # Send ping every 30 seconds
         ws_ping_timeout=30,   # Wait 30 seconds for pong (ESP is slow)
+        # Bound per-connection read buffering; oversized frames close with 1009
+        ws_max_size=settings.WS_MAX_MESSAGE_BYTES,
+        ws_max_queue=settings.WS_MAX_QUEUE,
     )
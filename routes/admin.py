@@ -17,25 +17,45 @@ Author: deadboizxc
 Version: 1.0
 """
 
+import threading
+from cachetools import TTLCache
 from fastapi import APIRouter, Depends, HTTPException, Request
 from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
+from sqlalchemy import select
 from sqlalchemy.orm import Session
 from core.database import get_db
-from core.utils import is_device_online
-from core.models import User, Device, Message
-from fastapi.templating import Jinja2Templates
+from core.auth_cache import invalidate_device
+from core.models import User, Device
 from datetime import datetime
 from core.config import settings
-from core.utils import get_dynamic_base_url
+from core.relay import relay
+from core.templating import templates
+from core.utils import ONLINE_WINDOW_SECONDS, get_cached_system_stats, get_dynamic_base_url
 
 router = APIRouter(prefix="", tags=["admin"])
-templates = Jinja2Templates(directory="templates")
+
+# Rendered dashboard HTML per (user_id, base_url). Online state only changes
+# at minute granularity, so a few seconds of staleness skips DB and Jinja.
+DASHBOARD_CACHE_TTL = 15
+_dashboard_cache: TTLCache = TTLCache(maxsize=1024, ttl=DASHBOARD_CACHE_TTL)
+# The dashboard runs in the threadpool, TTLCache itself is not thread-safe
+_cache_lock = threading.Lock()
+
+
+def invalidate_dashboard(user_id: int) -> None:
+    """Drop cached dashboard pages of a user after their devices change."""
+    with _cache_lock:
+        for key in [k for k in list(_dashboard_cache.keys()) if k[0] == user_id]:
+            _dashboard_cache.pop(key, None)
 
 
 @router.get("/dashboard", response_class=HTMLResponse)
-async def dashboard(request: Request, db: Session = Depends(get_db)):
+def dashboard(request: Request, db: Session = Depends(get_db)):
     """Render the user dashboard page.
     
+    A plain def, so FastAPI runs it in the threadpool: the sync DB queries
+    and the Jinja render stay off the event loop.
+    
     Displays comprehensive device management interface with:
     - List of user's registered devices
     - Online/offline status indicators
@@ -68,38 +88,39 @@ async def dashboard(request: Request, db: Session = Depends(get_db)):
         return RedirectResponse(url="/login")
     
     try:
-        # Validate user exists in database
-        user = db.query(User).filter(User.id == int(user_id)).first()
-        if not user:
+        # Compute base URL from request headers (handles proxy/reverse proxy scenarios)
+        # Used for generating correct API endpoint URLs in the dashboard
+        base_url = get_dynamic_base_url(request)
+
+        # Serve a recently rendered page without touching DB or Jinja
+        cache_key = (int(user_id), base_url)
+        with _cache_lock:
+            cached_body = _dashboard_cache.get(cache_key)
+        if cached_body is not None:
+            return HTMLResponse(content=cached_body)
+
+        # Validate user exists and fetch the columns the dashboard shows in
+        # one round trip: user LEFT JOIN devices, as plain rows (no ORM objects).
+        # A user without devices yields one row with NULL device columns.
+        rows = db.execute(
+            select(
+                User.id, User.username, User.plan, User.devices_limit, User.api_token,
+                Device.device_id, Device.device_token, Device.last_seen,
+                Device.last_seen_ts, Device.poll_count, Device.added,
+                Device.last_request_counter
+            )
+            .outerjoin(Device, Device.user_id == User.id)
+            .where(User.id == int(user_id))
+        ).all()
+        if not rows:
             # Invalid user_id in cookie - session expired or tampered
             return RedirectResponse(url="/login")
-        
-        # Fetch all devices registered to this user
-        devices = db.query(Device).filter(Device.user_id == int(user_id)).all()
-
-        # Count devices that have been seen within the last 5 minutes or have active WSS
-        online_count = sum(1 for device in devices if is_device_online(device.last_seen, device.device_id))
-
-        # Calculate system-wide statistics for admin overview
-        from datetime import timedelta
-        from core.relay import relay
-        five_min_ago = datetime.now().astimezone() - timedelta(minutes=5)
-
-        # Count online devices: WSS connected OR seen in last 5 min
-        wss_connected = set(relay.get_connected_devices())
-        http_online = set(d.device_id for d in db.query(Device).filter(Device.last_seen >= five_min_ago).all())
-        total_online = len(wss_connected | http_online)
-
-        # Aggregate system statistics across all users/devices
-        # Used for admin dashboard overview panel
-        system_stats = {
-            "online_devices": total_online,  # Devices with active WSS or seen in last 5 min
-            "wss_connections": len(wss_connected),  # Active WebSocket connections
-            "total_devices": db.query(Device).count(),  # All registered devices
-            "total_users": db.query(User).count(),  # Total registered users
-            "queues_to_device": db.query(Message).filter(Message.direction == 'to_device').count(),  # Pending commands
-            "queues_to_client": db.query(Message).filter(Message.direction == 'to_client').count(),  # Pending responses
-        }
+        user = rows[0]
+        devices = [row for row in rows if row.device_id is not None]
+
+        # System statistics across all users/devices, shared with /api/stats
+        # and cached for a few seconds. Used for admin dashboard overview panel
+        system_stats = get_cached_system_stats(db)
 
         # Prepare user data structure for Jinja2 template rendering
         user_data = {
@@ -110,32 +131,45 @@ async def dashboard(request: Request, db: Session = Depends(get_db)):
             "devices": []
         }
 
-        # Build device list with computed online status for each device
+        # Build device list and count online devices in a single pass.
+        # Online = WSS connected OR seen in last 5 min, inlined from is_device_online
+        # with the connection map and cutoff bound once for the loop. One clock
+        # read serves both the cutoff and the displayed server time.
+        now = datetime.now()
+        connections = relay.connections
+        online_after = int(now.timestamp()) - ONLINE_WINDOW_SECONDS
+        online_count = 0
         for device in devices:
+            last_seen_ts = device.last_seen_ts
+            online = device.device_id in connections or bool(last_seen_ts and last_seen_ts > online_after)
+            online_count += online
+            last_seen, added = device.last_seen, device.added
+            # Cells are preformatted here; the template only interpolates strings
             user_data["devices"].append({
                 "device_id": device.device_id,  # Unique device identifier (e.g., WL123ABC)
                 "device_token": device.device_token,  # Secret token for ChaCha20/HMAC crypto
-                "online": is_device_online(device.last_seen, device.device_id),  # WSS connected or seen recently
-                "last_seen": device.last_seen,  # Last communication timestamp
+                "online": online,
+                "status_class": "status-online" if online else "status-offline",
+                "status_label": "Online" if online else "Offline",
+                "last_request_counter": device.last_request_counter or 0,
+                "last_seen_str": last_seen.strftime('%Y-%m-%d %H:%M') if last_seen else '—',  # Last communication
                 "poll_count": device.poll_count,  # Number of pull requests from device
-                "added": device.added  # Device registration timestamp
+                "added_str": added.strftime('%Y-%m-%d') if added else '—'  # Device registration date
             })
 
-        # Compute base URL from request headers (handles proxy/reverse proxy scenarios)
-        # Used for generating correct API endpoint URLs in the dashboard
-        base_url = get_dynamic_base_url(request)
-
-        
         # Render dashboard template with all context variables
-        return templates.TemplateResponse("dashboard.html", {
+        response = templates.TemplateResponse("dashboard.html", {
             "request": request,  # Required by Jinja2Templates
             "user": user_data,  # User profile and device list
             "api_token": user.api_token,  # For displaying in dashboard UI
             "online_count": online_count,  # User's online devices count
             "system_stats": system_stats,  # Server-wide statistics
-            "server_time": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),  # Display timestamp
+            "server_time": now.strftime('%Y-%m-%d %H:%M:%S'),  # Display timestamp
             "base_url": base_url  # For API endpoint references
         })
+        with _cache_lock:
+            _dashboard_cache[cache_key] = response.body
+        return response
         
     except Exception as e:
         # Log error and redirect to login on any exception
@@ -201,6 +235,8 @@ async def dashboard_delete_device(request: Request, db: Session = Depends(get_db
         device_id = device.device_id
         db.delete(device)
         db.commit()
+        invalidate_device(device_id)
+        invalidate_dashboard(user.id)
         
         return JSONResponse(content={
             "status": "ok",
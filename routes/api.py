@@ -2,6 +2,10 @@
 
 This module provides HTTP REST endpoints for device management and message relay.
 All endpoints require API token authentication via Authorization header.
+Database access goes through an AsyncSession (aiosqlite), so queries never
+block the event loop serving WebSocket and long-poll connections.
+Hot endpoints return ORJSONResponse directly, which skips FastAPI's
+jsonable_encoder / response_model pass; orjson encodes datetimes itself.
 
 The server acts as a transparent relay - it never decrypts the payload,
 only validates API tokens and forwards outer JSON packets.
@@ -12,21 +16,31 @@ Version: 1.0
 
 import asyncio
 import logging
-from datetime import datetime, timedelta
-from typing import Optional
-
-from fastapi import APIRouter, Depends, HTTPException, Header
-from sqlalchemy.orm import Session
-
-from core.database import get_db
-from core.auth import validate_api_token, save_device, delete_device
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, Optional, Type
+
+import orjson
+from fastapi import APIRouter, Depends, HTTPException, Header, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import ORJSONResponse, Response
+from pydantic import BaseModel, ValidationError
+from sqlalchemy import bindparam, delete, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from core.database import get_async_db
+from core.auth import save_device, delete_device
+from core.auth_cache import CachedUser, get_api_user, invalidate_device, peek_api_user
 from core.schemas import (
     PushMessage, PullRequest,
     DeviceCreate, DeviceRegisteredResponse, UserDevicesResponse,
     DeleteDeviceRequest, MessageResponse
 )
-from core.models import Message, Device, User
+from core.models import Message, Device
+from core.config import settings
+from core.last_seen_tracker import last_seen_tracker
 from core.relay import relay
+from core.utils import get_cached_system_stats, is_device_online, peek_system_stats
 
 router = APIRouter(prefix="/api", tags=["api"])
 logger = logging.getLogger("wakelink_cloud")
@@ -48,95 +62,146 @@ async def get_api_token(
         The extracted API token string, or None if not found.
     """
     if authorization and authorization.startswith("Bearer "):
-        return authorization.replace("Bearer ", "")
+        # Slice off the prefix; no scan of the rest of the value
+        return authorization[7:]
     return x_api_token
 
 
 async def validate_api_token_dependency(
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     api_token: Optional[str] = Depends(get_api_token)
-) -> User:
+) -> CachedUser:
     """Validate API token and return the associated user.
 
+    Lookups go through the in-process token cache (core.auth_cache), so
+    steady-state requests do not query the users table. A cache hit is
+    answered directly, without a hop into the session's sync context.
+
     Args:
         db: Database session.
         api_token: The API token to validate.
 
     Returns:
-        The User object if token is valid.
+        The CachedUser tuple if token is valid.
 
     Raises:
         HTTPException: If token is invalid or missing.
     """
     if not api_token:
         raise HTTPException(status_code=401, detail="API token required")
-    user = validate_api_token(db, api_token)
+    user = peek_api_user(api_token)
+    if user is None:
+        user = await db.run_sync(get_api_user, api_token)
     if not user:
         raise HTTPException(status_code=401, detail="Invalid API token")
     return user
 
 
-def _is_device_online(last_seen: Optional[datetime]) -> bool:
-    """Check if a device is considered online.
+def json_body(model: Type[BaseModel]) -> Callable:
+    """Dependency that decodes and validates a JSON body in one pass.
 
-    A device is online if it was seen within the last 5 minutes.
+    pydantic-core parses the raw bytes straight into the model, skipping
+    FastAPI's json.loads -> dict -> validate round trip. Invalid bodies
+    still produce FastAPI's usual 422 response.
+    """
+    async def parse(request: Request):
+        try:
+            return model.model_validate_json(await request.body())
+        except ValidationError as e:
+            raise RequestValidationError(e.errors(include_url=False))
+    return parse
 
-    Args:
-        last_seen: The last seen timestamp of the device.
 
-    Returns:
-        True if the device is online, False otherwise.
-    """
-    if not last_seen:
-        return False
-    try:
-        return (datetime.now().astimezone() - last_seen) < timedelta(minutes=5)
-    except Exception:
-        return False
+def json_body_openapi(model: Type[BaseModel]) -> Dict[str, Any]:
+    """openapi_extra documenting a body parsed by json_body()."""
+    return {"requestBody": {
+        "required": True,
+        "content": {"application/json": {"schema": model.model_json_schema()}}
+    }}
+
+
+# Monitoring scrapes and dashboards may reuse /api/stats for this long
+STATS_MAX_AGE = 5  # seconds
+# Static part of /api/health, serialized once
+_HEALTH_PREFIX = b'{"status":"healthy","service":"WakeLink Cloud Relay","timestamp":'
 
 
 @router.get("/stats")
-async def api_stats(db: Session = Depends(get_db)):
-    """Get server statistics including device and user counts."""
-    from datetime import datetime, timedelta
-    
-    five_min_ago = datetime.now().astimezone() - timedelta(minutes=5)
-    online = db.query(Device).filter(Device.last_seen >= five_min_ago).count()
-    total = db.query(Device).count()
-    total_users = db.query(User).count()
-    queues_to_device = db.query(Message).filter(Message.direction == 'to_device').count()
-    queues_to_client = db.query(Message).filter(Message.direction == 'to_client').count()
+async def api_stats(
+    db: AsyncSession = Depends(get_async_db),
+    if_none_match: Optional[str] = Header(None)
+):
+    """Get server statistics including device and user counts.
+
+    Counts are cached for SYSTEM_STATS_CACHE_TTL seconds (shared with the
+    dashboard), so only the first request in a window queries the DB.
+    Responses carry Cache-Control: max-age and a weak ETag over the
+    counters (server_time is excluded), answering If-None-Match with 304.
+    """
+    stats = peek_system_stats()
+    if stats is None:
+        stats = await db.run_sync(get_cached_system_stats)
     
     # WebSocket statistics
-    ws_connections = len(relay.connections)
+    ws_connections = relay.connection_count
     
-    return {
-        "online_devices": online,
-        "total_devices": total,
-        "total_users": total_users,
-        "queues_to_device": queues_to_device,
-        "queues_to_client": queues_to_client,
-        "total_queues": queues_to_device + queues_to_client,
+    etag = 'W/"{}-{}-{}-{}-{}-{}"'.format(
+        stats["online_devices"], stats["total_devices"], stats["total_users"],
+        stats["queues_to_device"], stats["queues_to_client"], ws_connections
+    )
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={STATS_MAX_AGE}"}
+    if if_none_match == etag:
+        return Response(status_code=304, headers=headers)
+    
+    return ORJSONResponse({
+        "online_devices": stats["online_devices"],
+        "total_devices": stats["total_devices"],
+        "total_users": stats["total_users"],
+        "queues_to_device": stats["queues_to_device"],
+        "queues_to_client": stats["queues_to_client"],
+        "total_queues": stats["queues_to_device"] + stats["queues_to_client"],
         "websocket_connections": ws_connections,
-        "server_time": datetime.now().isoformat(),
+        "server_time": datetime.now(),
         "status": "running"
-    }
+    }, headers=headers)
 
 @router.get("/health")
 async def api_health():
-    """Health check endpoint for monitoring services."""
-    return {
-        "status": "healthy",
-        "service": "WakeLink Cloud Relay",
-        "timestamp": datetime.now().isoformat(),
-        "websockets": len(relay.connections)
-    }
+    """Health check endpoint for monitoring services.
+
+    Never cached: a liveness probe must reach this process. Only the
+    timestamp and connection count are serialized per call.
+    """
+    body = b"".join((
+        _HEALTH_PREFIX, orjson.dumps(datetime.now()),
+        b',"websockets":', str(relay.connection_count).encode(), b"}"
+    ))
+    return Response(content=body, media_type="application/json",
+                    headers={"Cache-Control": "no-store"})
+
+# Built once at import: INSERT ... VALUES (..., (SELECT device_token ...)) RETURNING
+# device_token, which is NULL when the device is not registered
+_PUSH_INSERT_STMT = (
+    insert(Message)
+    .values(
+        device_id=bindparam("b_device_id"),
+        device_token=select(Device.device_token)
+        .where(Device.device_id == bindparam("b_device_id"))
+        .scalar_subquery(),
+        message_type=bindparam("b_message_type"),
+        message_data=bindparam("b_message_data"),
+        signature=bindparam("b_signature"),
+        direction=bindparam("b_direction")
+    )
+    .returning(Message.device_token)
+)
 
-@router.post("/push", response_model=MessageResponse)
+
+@router.post("/push", response_model=MessageResponse, openapi_extra=json_body_openapi(PushMessage))
 async def push_message(
-    msg: PushMessage,
-    db: Session = Depends(get_db),
-    user: User = Depends(validate_api_token_dependency)
+    msg: PushMessage = Depends(json_body(PushMessage)),
+    db: AsyncSession = Depends(get_async_db),
+    user: CachedUser = Depends(validate_api_token_dependency)
 ):
     """Send a message to a device.
 
@@ -151,27 +216,25 @@ async def push_message(
     Returns:
         Response indicating success and delivery status.
     """
-    # Update device last seen time
-    device = db.query(Device).filter(Device.device_id == msg.device_id).first()
-    if device:
-        device.last_seen = datetime.now().astimezone()
-        db.commit()
+    # Save message to database for the device; one statement looks up the
+    # device token, inserts the row and tells us whether the device exists
+    device_token = (await db.execute(_PUSH_INSERT_STMT, {
+        "b_device_id": msg.device_id,
+        "b_message_type": "command" if msg.direction == "to_device" else "response",
+        "b_message_data": msg.payload,
+        "b_signature": msg.signature,
+        "b_direction": msg.direction
+    })).scalar()
+    await db.commit()
+    relay.notify_pull(msg.device_id, msg.direction)
     
-    # Save message to database for the device
-    message = Message(
-        device_id=msg.device_id,
-        device_token=device.device_token if device else None,
-        message_type="command" if msg.direction == "to_device" else "response",
-        message_data=msg.payload,
-        signature=msg.signature,
-        direction=msg.direction
-    )
-    db.add(message)
-    db.commit()
+    # Update device last seen time (written behind, batched)
+    if device_token is not None:
+        last_seen_tracker.touch(msg.device_id)
     
     # Try to deliver immediately via WebSocket if device is online
     delivered = False
-    if device:
+    if device_token is not None:
         delivered = await relay.push(msg.device_id, {
             "device_id": msg.device_id,
             "payload": msg.payload,
@@ -179,17 +242,26 @@ async def push_message(
             "version": msg.version
         })
     
-    return {
+    # Returned as a Response so FastAPI skips re-validating it against
+    # response_model; keys mirror MessageResponse exactly
+    return ORJSONResponse({
         "status": "ok",
         "device_id": msg.device_id,
-        "delivered_via_ws": delivered
-    }
+        "delivered_via_ws": delivered,
+        "messages": None,
+        "count": 0
+    })
+
+# An empty MessageResponse for /api/pull, around the device_id
+_EMPTY_PULL_PREFIX = b'{"status":"ok","device_id":'
+_EMPTY_PULL_SUFFIX = b',"delivered_via_ws":false,"messages":[],"count":0}'
 
-@router.post("/pull", response_model=MessageResponse)
+
+@router.post("/pull", response_model=MessageResponse, openapi_extra=json_body_openapi(PullRequest))
 async def pull_messages(
-    msg: PullRequest,
-    db: Session = Depends(get_db),
-    user: User = Depends(validate_api_token_dependency)
+    msg: PullRequest = Depends(json_body(PullRequest)),
+    db: AsyncSession = Depends(get_async_db),
+    user: CachedUser = Depends(validate_api_token_dependency)
 ):
     """Retrieve pending messages for a device with optional long polling.
 
@@ -198,6 +270,9 @@ async def pull_messages(
     
     Long polling: If wait > 0, server will hold the connection for up to
     'wait' seconds until messages arrive, enabling near-instant responses.
+    The wait is woken by push_message via relay.notify_pull; the database is
+    only re-checked every PULL_RECHECK_SECONDS, to catch pushes handled by
+    another worker process.
 
     Args:
         msg: The pull request containing device_id and optional wait time.
@@ -207,45 +282,71 @@ async def pull_messages(
     Returns:
         Response with list of messages for the device.
     """
-    # Update device last seen (always) and poll count (only for real polls, not heartbeats)
-    device = db.query(Device).filter(Device.device_id == msg.device_id).first()
-    if device:
-        device.last_seen = datetime.now().astimezone()
-        db.commit()
+    # Update device last seen (always) and poll count (only for real polls, not heartbeats).
+    # Both are written behind in batches; unknown device_ids simply match no row.
+    last_seen_tracker.touch(msg.device_id)
     
     # Long polling support
     wait_time = min(msg.wait or 0, 30)  # Max 30 seconds
-    start_time = datetime.now()
-    poll_interval = 0.1  # 100ms between DB checks
+    deadline = time.monotonic() + wait_time
     
     messages = []
     
     while True:
-        # Get all messages for the device based on requested direction
-        messages = db.query(Message).filter(
-            Message.device_id == msg.device_id,
-            Message.direction == msg.direction
-        ).order_by(Message.timestamp).all()
-        
-        # If we have messages or not long polling, return immediately
-        if messages or wait_time == 0:
-            break
-        
-        # Check if we've waited long enough
-        elapsed = (datetime.now() - start_time).total_seconds()
-        if elapsed >= wait_time:
-            break
-        
-        # Wait a bit before checking again
-        await asyncio.sleep(poll_interval)
-        
-        # Refresh DB session to see new messages
-        db.expire_all()
+        # Long-pollers register before querying, so a push landing between the
+        # query and the wait still wakes them; wait=0 polls never register
+        event = relay.pull_event(msg.device_id, msg.direction) if wait_time > 0 else None
+        try:
+            # Fetch and remove queued messages in one atomic DELETE ... RETURNING,
+            # so two racing pollers can never both receive the same message
+            messages = (await db.execute(
+                delete(Message)
+                .where(
+                    Message.device_id == msg.device_id,
+                    Message.direction == msg.direction
+                )
+                .returning(
+                    Message.id, Message.device_id, Message.message_type, Message.message_data,
+                    Message.signature, Message.direction, Message.timestamp
+                )
+            )).all()
+            
+            # If we have messages or not long polling, return immediately
+            if messages or event is None:
+                break
+            
+            # Check if we've waited long enough
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            
+            # End the (empty) write transaction so the SQLite write lock isn't held while waiting
+            await db.commit()
+            
+            # Sleep until a push for this device/direction arrives
+            try:
+                await asyncio.wait_for(event.wait(), timeout=min(remaining, settings.PULL_RECHECK_SECONDS))
+            except asyncio.TimeoutError:
+                pass
+        finally:
+            if event is not None:
+                relay.release_pull_event(msg.device_id, msg.direction)
+    
+    await db.commit()
+    
+    # Most polls are empty heartbeats: answer from a prebuilt template.
+    # Only the device_id is serialized (orjson escapes it).
+    if not messages:
+        return Response(
+            content=_EMPTY_PULL_PREFIX + orjson.dumps(msg.device_id) + _EMPTY_PULL_SUFFIX,
+            media_type="application/json"
+        )
     
     # Only increment poll_count if there were actual messages (not just heartbeat)
-    if device and len(messages) > 0:
-        device.poll_count += 1
-        db.commit()
+    last_seen_tracker.add_poll(msg.device_id)
+    
+    # RETURNING order is unspecified; deliver oldest first
+    messages.sort(key=lambda m: (m.timestamp, m.id))
     
     result = []
     for msg_obj in messages:
@@ -256,20 +357,16 @@ async def pull_messages(
             "payload": msg_obj.message_data,
             "signature": msg_obj.signature or "",
             "direction": msg_obj.direction,
-            "timestamp": msg_obj.timestamp.isoformat() if msg_obj.timestamp else None
+            "timestamp": msg_obj.timestamp  # orjson writes ISO 8601 natively
         })
     
-    # Delete delivered messages
-    for message in messages:
-        db.delete(message)
-    db.commit()
-    
-    return {
+    return ORJSONResponse({
         "status": "ok",
         "device_id": msg.device_id,
+        "delivered_via_ws": False,
         "messages": result,
         "count": len(result)
-    }
+    })
 
 # =============================
 # Client endpoints (API token in headers)
@@ -278,8 +375,8 @@ async def pull_messages(
 @router.post("/register_device", response_model=DeviceRegisteredResponse)
 async def api_register_device(
     device_data: DeviceCreate,
-    db: Session = Depends(get_db),
-    user: User = Depends(validate_api_token_dependency)
+    db: AsyncSession = Depends(get_async_db),
+    user: CachedUser = Depends(validate_api_token_dependency)
 ):
     """Register a new device for the authenticated user.
 
@@ -294,7 +391,7 @@ async def api_register_device(
         Device registration response.
     """
     try:
-        device = save_device(db, user.id, device_data.device_id, device_data.device_data or {})
+        device = await db.run_sync(save_device, user.id, device_data.device_id, device_data.device_data or {})
         return {
             "status": "device_registered",
             "device_id": device.device_id,
@@ -307,8 +404,8 @@ async def api_register_device(
 @router.post("/delete_device", response_model=dict)
 async def api_delete_device(
     request: DeleteDeviceRequest,
-    db: Session = Depends(get_db),
-    user: User = Depends(validate_api_token_dependency)
+    db: AsyncSession = Depends(get_async_db),
+    user: CachedUser = Depends(validate_api_token_dependency)
 ):
     """Delete a device for the authenticated user.
 
@@ -322,7 +419,7 @@ async def api_delete_device(
     Returns:
         Deletion confirmation.
     """
-    success, message = delete_device(db, user.api_token, request.device_id)
+    success, message = await db.run_sync(delete_device, user.api_token, request.device_id)
     if success:
         return {
             "status": "device_deleted",
@@ -333,8 +430,8 @@ async def api_delete_device(
 
 @router.get("/devices", response_model=UserDevicesResponse)
 async def api_devices(
-    db: Session = Depends(get_db),
-    user: User = Depends(validate_api_token_dependency)
+    db: AsyncSession = Depends(get_async_db),
+    user: CachedUser = Depends(validate_api_token_dependency)
 ):
     """Get list of devices for the authenticated user.
 
@@ -347,19 +444,26 @@ async def api_devices(
     Returns:
         List of user's devices with status information.
     """
-    devices = db.query(Device).filter(Device.user_id == user.id).all()
-    devices_list = []
+    # Plain Core rows: the user is already known from the token cache and
+    # no ORM objects (identity map, instance state) are built for devices
+    rows = (await db.execute(
+        select(
+            Device.device_id, Device.cloud, Device.last_seen,
+            Device.last_seen_ts, Device.poll_count, Device.added
+        ).where(Device.user_id == user.id)
+    )).all()
+    # Clock and connection map read once for all rows
+    now_ts = int(time.time())
+    connected = relay.connections
     
-    for device in devices:
-        online = _is_device_online(device.last_seen)
-        devices_list.append({
-            "device_id": device.device_id,
-            "cloud": device.cloud,
-            "online": online,
-            "last_seen": device.last_seen,
-            "poll_count": device.poll_count,
-            "added": device.added
-        })
+    devices_list = [{
+        "device_id": row.device_id,
+        "cloud": row.cloud,
+        "online": is_device_online(row.last_seen_ts, row.device_id, now_ts, connected),
+        "last_seen": row.last_seen,
+        "poll_count": row.poll_count,
+        "added": row.added
+    } for row in rows]
 
     return {
         "user": user.username,
@@ -375,8 +479,8 @@ async def api_devices(
 @router.post("/device/create")
 async def api_device_create(
     payload: dict,
-    db: Session = Depends(get_db),
-    user: User = Depends(validate_api_token_dependency)
+    db: AsyncSession = Depends(get_async_db),
+    user: CachedUser = Depends(validate_api_token_dependency)
 ):
     """Create a device. Expects device_id and device_token in body."""
     device_id = payload.get("device_id")
@@ -385,7 +489,7 @@ async def api_device_create(
         raise HTTPException(status_code=400, detail="device_id and device_token required")
 
     try:
-        device = save_device(db, user.id, device_id, {"device_token": device_token})
+        device = await db.run_sync(save_device, user.id, device_id, {"device_token": device_token})
         return {"status": "ok", "device_id": device_id, "device_token": device_token}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -393,24 +497,27 @@ async def api_device_create(
 @router.get("/device/")
 async def api_device_get(
     device_id: str,
-    db: Session = Depends(get_db),
-    user: User = Depends(validate_api_token_dependency)
+    db: AsyncSession = Depends(get_async_db),
+    user: CachedUser = Depends(validate_api_token_dependency)
 ):
     """Get device information by device_id."""
-    device = db.query(Device).filter(Device.device_id == device_id, Device.user_id == user.id).first()
+    device = (await db.execute(
+        select(Device.device_id, Device.cloud, Device.last_seen)
+        .where(Device.device_id == device_id, Device.user_id == user.id)
+    )).first()
     if not device:
         raise HTTPException(status_code=404, detail="device not found")
     return {
         "device_id": device.device_id,
-        "cloud": getattr(device, 'cloud', False),
-        "last_seen": getattr(device, 'last_seen', None)
+        "cloud": bool(device.cloud),
+        "last_seen": device.last_seen
     }
 
 @router.put("/device/update")
 async def api_device_update(
     payload: dict,
-    db: Session = Depends(get_db),
-    user: User = Depends(validate_api_token_dependency)
+    db: AsyncSession = Depends(get_async_db),
+    user: CachedUser = Depends(validate_api_token_dependency)
 ):
     """Update device (partial). Expects device_id, device_token, and optionally signature/version."""
     device_id = payload.get("device_id")
@@ -418,7 +525,9 @@ async def api_device_update(
     if not device_id or not device_token:
         raise HTTPException(status_code=400, detail="device_id and device_token required")
 
-    device = db.query(Device).filter(Device.device_id == device_id, Device.user_id == user.id).first()
+    device = (await db.execute(
+        select(Device).where(Device.device_id == device_id, Device.user_id == user.id)
+    )).scalar_one_or_none()
     if not device:
         raise HTTPException(status_code=404, detail="device not found")
 
@@ -426,15 +535,16 @@ async def api_device_update(
     device.device_token = device_token
     if 'version' in payload:
         device.version = payload.get('version')
-    db.commit()
+    await db.commit()
+    invalidate_device(device_id)
 
     return {"status": "ok", "device_id": device_id}
 
 @router.delete("/device/delete")
 async def api_device_delete(
     payload: dict,
-    db: Session = Depends(get_db),
-    user: User = Depends(validate_api_token_dependency)
+    db: AsyncSession = Depends(get_async_db),
+    user: CachedUser = Depends(validate_api_token_dependency)
 ):
     """Delete device by device_id and device_token."""
     device_id = payload.get("device_id")
@@ -442,9 +552,12 @@ async def api_device_delete(
     if not device_id or not device_token:
         raise HTTPException(status_code=400, detail="device_id and device_token required")
 
-    device = db.query(Device).filter(Device.device_id == device_id, Device.user_id == user.id).first()
+    device = (await db.execute(
+        select(Device).where(Device.device_id == device_id, Device.user_id == user.id)
+    )).scalar_one_or_none()
     if not device:
         raise HTTPException(status_code=404, detail="device not found")
-    db.delete(device)
-    db.commit()
+    await db.delete(device)
+    await db.commit()
+    invalidate_device(device_id)
     return {"status": "device_deleted", "device_id": device_id}
\ No newline at end of file
@@ -14,22 +14,26 @@ Authentication Flow:
 Security Notes:
     - Passwords are hashed before storage (see core.auth)
     - API tokens are generated on registration for programmatic access
-    - Cookies should be secured with HttpOnly/Secure flags in production
+    - Session cookies are HttpOnly and SameSite=Lax, plus Secure over HTTPS
 
 Author: deadboizxc
 Version: 1.0
 """
 
-from fastapi import APIRouter, Depends, HTTPException, status, Request, Form, Response
-from fastapi.templating import Jinja2Templates
+from http.cookies import SimpleCookie
+from typing import Optional
+
+from fastapi import APIRouter, Cookie, Depends, HTTPException, status, Request, Form, Response
 from fastapi.responses import HTMLResponse, RedirectResponse
 from sqlalchemy.orm import Session
 from core.database import get_db
-from core.auth import create_user, authenticate_user
+from core.auth import create_user_async, authenticate_user_async
+from core.auth_cache import invalidate_api_token
 from core.schemas import UserCreate, UserLogin
+from core.templating import templates
+from core.utils import get_dynamic_base_url
 
 router = APIRouter(prefix="", tags=["authentication"])
-templates = Jinja2Templates(directory="templates")
 
 
 def no_cache_response(response: Response):
@@ -39,6 +43,30 @@ def no_cache_response(response: Response):
     return response
 
 
+def set_session_cookies(response: Response, request: Request, user) -> None:
+    """Append the session cookies as one SimpleCookie pass.
+    
+    Cookies are HttpOnly and SameSite=Lax; Secure is added when the request
+    reached us over HTTPS (directly or via X-Forwarded-Proto), so plain-HTTP
+    local deployments can still log in.
+    """
+    cookie = SimpleCookie()
+    cookie["user_id"] = str(user.id)  # Primary session identifier
+    cookie["username"] = user.username  # Display name
+    cookie["api_token"] = user.api_token  # API access token
+    secure = get_dynamic_base_url(request).startswith("https:")
+    for morsel in cookie.values():
+        morsel["path"] = "/"
+        morsel["httponly"] = True
+        morsel["samesite"] = "Lax"
+        if secure:
+            morsel["secure"] = True
+    response.raw_headers.extend(
+        (b"set-cookie", morsel.OutputString().encode("latin-1"))
+        for morsel in cookie.values()
+    )
+
+
 @router.get("/register", response_class=HTMLResponse)
 async def web_register(request: Request, response: Response):
     """Render the user registration page.
@@ -86,7 +114,8 @@ async def web_register_post(
     user_data = UserCreate(username=username, password=password)
     
     # Attempt to create user - returns (user, None) on success, (None, error) on failure
-    user, error = create_user(db, user_data)
+    # Hashing runs in the password thread pool, off the event loop
+    user, error = await create_user_async(db, user_data)
     
     if error:
         # Registration failed - re-render form with error message
@@ -101,9 +130,7 @@ async def web_register_post(
     response = RedirectResponse(url="/dashboard", status_code=status.HTTP_303_SEE_OTHER)
     
     # Set session cookies for authentication persistence
-    response.set_cookie(key="user_id", value=str(user.id))  # Primary session identifier
-    response.set_cookie(key="username", value=user.username)  # Display name
-    response.set_cookie(key="api_token", value=user.api_token)  # For client-side API calls
+    set_session_cookies(response, request, user)
     
     return response
 
@@ -151,8 +178,8 @@ async def web_login_post(
     # Create login data transfer object
     login_data = UserLogin(username=username, password=password)
     
-    # Verify credentials - returns User on success, None on failure
-    user = authenticate_user(db, login_data)
+    # Verify credentials off the event loop - returns User on success, None on failure
+    user = await authenticate_user_async(db, login_data)
     
     if not user:
         # Authentication failed - invalid username or password
@@ -163,26 +190,31 @@ async def web_login_post(
     
     # Authentication successful - establish session via cookies
     response = RedirectResponse(url="/dashboard", status_code=status.HTTP_303_SEE_OTHER)
-    response.set_cookie(key="user_id", value=str(user.id))  # Session identifier
-    response.set_cookie(key="username", value=user.username)  # Display name
-    response.set_cookie(key="api_token", value=user.api_token)  # API access token
+    set_session_cookies(response, request, user)
     
     return response
 
 
 @router.get("/logout")
-async def logout():
+async def logout(api_token: Optional[str] = Cookie(None)):
     """Log out the current user and clear session.
     
     Clears all authentication cookies and redirects to home page.
     This effectively ends the user's session.
     
+    Args:
+        api_token: The session's API token cookie, if any.
+    
     Returns:
         RedirectResponse: Redirect to home page (/) with cleared cookies.
     
     Side Effects:
         Deletes session cookies: user_id, username, api_token.
+        Drops the token from the in-process token cache.
     """
+    if api_token:
+        invalidate_api_token(api_token)
+    
     # Create redirect response to home page
     response = RedirectResponse(url="/")
     
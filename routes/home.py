@@ -16,29 +16,36 @@ Author: deadboizxc
 Version: 1.0
 """
 
+from cachetools import LRUCache
 from fastapi import APIRouter, Request, Depends
 from fastapi.responses import HTMLResponse
-from fastapi.templating import Jinja2Templates
 from sqlalchemy.orm import Session
 
 from core.utils import get_dynamic_base_url, get_stored_base_url
 from core.config import settings
 from core.database import get_db
+from core.templating import templates
 
 router = APIRouter(prefix="", tags=["home"])
-templates = Jinja2Templates(directory="templates")
+
+# Rendered home.html per (base_url, request base URL). The page has no other
+# dynamic input, so a hit skips Jinja entirely. Bounded, as keys come from
+# client-supplied Host / X-Forwarded-* headers.
+_home_cache: LRUCache = LRUCache(maxsize=32)
 
 
 @router.get("/", response_class=HTMLResponse)
-async def home(request: Request, db: Session = Depends(get_db)):
+async def home(request: Request):
     """Render the WakeLink Cloud Server landing page.
     
     Public endpoint displaying server information, documentation links,
     and quick start guides for new users.
     
+    The rendered page is cached per URL pair (see _home_cache); the
+    DATABASE_FILE shown on it is constant for the process.
+    
     Args:
         request: The FastAPI request object.
-        db: Database session dependency.
     
     Returns:
         HTMLResponse: Rendered home.html template with server context.
@@ -51,14 +58,20 @@ async def home(request: Request, db: Session = Depends(get_db)):
     # Compute base URL from request headers
     # Handles reverse proxy scenarios (X-Forwarded-Proto, X-Forwarded-Host)
     base_url = get_dynamic_base_url(request)
-    # Alternative: Use URL stored in database settings
+    # Alternative: Use URL stored in database settings (needs a Session)
     # base_url = get_stored_base_url(db)
 
-    return templates.TemplateResponse("home.html", {
-        "request": request,  # Required by Jinja2Templates
-        "database_file": settings.DATABASE_FILE,  # Display current DB path
-        "base_url": base_url  # For API endpoint documentation
-    })
+    # url_for() in base.html renders from the request's own base URL
+    cache_key = (base_url, str(request.base_url))
+    body = _home_cache.get(cache_key)
+    if body is None:
+        response = templates.TemplateResponse("home.html", {
+            "request": request,  # Required by Jinja2Templates
+            "database_file": settings.DATABASE_FILE,  # Display current DB path
+            "base_url": base_url  # For API endpoint documentation
+        })
+        body = _home_cache[cache_key] = response.body
+    return HTMLResponse(content=body)
 
 
 @router.get("/test")
@@ -91,7 +104,7 @@ async def test_endpoint(request: Request, db: Session = Depends(get_db)):
     return {
         "message": "WakeLink server is running",
         "base_url": base_url,  # Primary URL for API access
-        "dynamic_url": get_dynamic_base_url(request),  # Computed from request
+        "dynamic_url": base_url,  # Computed from request (same value)
         "stored_url": get_stored_base_url(db),  # From database settings
         "endpoints": {
             # Common API endpoints for quick reference
@@ -20,24 +20,149 @@ Version: 1.0
 """
 
 import asyncio
-import json
 import logging
-from datetime import datetime
-from typing import Optional
+from typing import Optional, Sequence, Union
 
+import orjson
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect
-from sqlalchemy.orm import Session
 
-from core.database import get_db
-from core.auth import validate_api_token, validate_device_token
-from core.models import Message, Device
-from core.relay import relay
+from core.database import AsyncSessionLocal
+from core.auth import validate_device_token
+from core.auth_cache import get_api_user, get_owned_device, peek_api_user, peek_owned_device
+from core.last_seen_tracker import last_seen_tracker
+from core.message_writer import message_writer
+from core.relay import relay, encode_frame
 
 router = APIRouter(tags=["websocket"])
 logger = logging.getLogger("wakelink_cloud")
 
 # Authentication timeout in seconds
 AUTH_TIMEOUT = 10.0
+# Outer packet fields every data frame must carry (protocol v1.0)
+REQUIRED_FIELDS = frozenset(("device_id", "payload", "signature", "version"))
+# Full outer response packet; device frames with exactly these keys are
+# already in the shape clients expect and are forwarded verbatim
+RESPONSE_FIELDS = REQUIRED_FIELDS | {"request_counter"}
+
+# Constant control frames, serialized once at import
+AUTH_HEADER_REQUIRED_FRAME = encode_frame({
+    "status": "error",
+    "error": "AUTH_REQUIRED",
+    "message": "Authorization header with Bearer token is required"
+})
+AUTH_MESSAGE_REQUIRED_FRAME = encode_frame({
+    "status": "error",
+    "error": "AUTH_REQUIRED",
+    "message": "Authentication required. Send: {\"type\": \"auth\", \"token\": \"<api_token>\"}"
+})
+INVALID_API_TOKEN_FRAME = encode_frame({
+    "status": "error",
+    "error": "INVALID_API_TOKEN",
+    "message": "Invalid API token"
+})
+INVALID_TOKEN_FRAME = encode_frame({
+    "status": "error",
+    "error": "INVALID_TOKEN",
+    "message": "Invalid API token"
+})
+DEVICE_INVALID_JSON_FRAME = encode_frame({
+    "status": "error",
+    "error": "INVALID_JSON",
+    "message": "Failed to parse JSON"
+})
+CLIENT_INVALID_JSON_FRAME = encode_frame({"status": "error", "error": "INVALID_JSON"})
+DEVICE_UNSUPPORTED_VERSION_FRAME = encode_frame({
+    "status": "error",
+    "error": "UNSUPPORTED_VERSION",
+    "message": "Protocol version must be 1.0"
+})
+CLIENT_UNSUPPORTED_VERSION_FRAME = encode_frame({"status": "error", "error": "UNSUPPORTED_VERSION"})
+INVALID_FIELD_TYPES_FRAME = encode_frame({
+    "status": "error",
+    "error": "INVALID_PACKET",
+    "message": "device_id, payload and signature must be strings"
+})
+
+# Welcome frames differ only in the id; the JSON-encoded id is %-interpolated
+DEVICE_WELCOME_TEMPLATE = (
+    '{"type":"welcome","status":"connected","device_id":%s,'
+    '"protocol_version":"1.0","message":"WebSocket connection established"}'
+)
+CLIENT_WELCOME_TEMPLATE = (
+    '{"type":"welcome","status":"connected","client_id":%s,'
+    '"protocol_version":"1.0","message":"Client WebSocket connection established"}'
+)
+# Per-command client ACKs, same shape: only the JSON-encoded device_id varies
+CLIENT_DELIVERED_ACK_TEMPLATE = (
+    '{"status":"success","device_id":%s,"delivered":true,"queued":false,'
+    '"message":"Delivered to device"}'
+)
+CLIENT_QUEUED_ACK_TEMPLATE = (
+    '{"status":"success","device_id":%s,"delivered":false,"queued":true,'
+    '"message":"Device offline, queued"}'
+)
+
+
+async def _send_json(websocket: WebSocket, data: Union[dict, str]) -> None:
+    """Send a JSON text frame encoded with orjson (instead of stdlib json).
+
+    Pre-serialized frames (str) are sent as-is.
+    """
+    await websocket.send_text(encode_frame(data))
+
+
+def _missing_fields(message_data) -> Sequence[str]:
+    """Required fields absent from a parsed frame, in sorted order.
+
+    Valid frames pass a keys-view superset test in C and get an empty
+    tuple back, so the common case allocates nothing; frames that are
+    not JSON objects lack every field.
+    """
+    if not isinstance(message_data, dict):
+        return sorted(REQUIRED_FIELDS)
+    if message_data.keys() >= REQUIRED_FIELDS:
+        return ()
+    return sorted(REQUIRED_FIELDS - message_data.keys())
+
+
+def _has_string_fields(message_data: dict) -> bool:
+    """device_id, payload and signature are str, as in the REST PushMessage.
+
+    Checked before a frame reaches the relay, the last_seen tracker or the
+    batched message writer, whose shared batches a bad value would fail.
+    """
+    return (
+        isinstance(message_data["device_id"], str)
+        and isinstance(message_data["payload"], str)
+        and isinstance(message_data["signature"], str)
+    )
+
+
+async def _receive_packet(websocket: WebSocket) -> Union[str, bytes]:
+    """Receive one data frame for orjson.loads().
+
+    Text frames (what the firmware sends) come back as str; binary frames
+    are returned as raw bytes, so orjson parses them without a UTF-8 decode
+    into an intermediate str.
+
+    Raises:
+        WebSocketDisconnect: If the peer closed the connection.
+    """
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    text = message.get("text")
+    return text if text is not None else message.get("bytes") or b""
+
+
+def _bearer_token(auth: Optional[str]) -> Optional[str]:
+    """Token from an 'Authorization: Bearer <token>' value, else None.
+
+    Only the 7-character scheme prefix is case-folded, never the token.
+    """
+    if auth and auth[:7].lower() == "bearer ":
+        return auth[7:]
+    return None
 
 
 def _extract_token_from_headers(websocket: WebSocket) -> Optional[str]:
@@ -53,9 +178,10 @@ def _extract_token_from_headers(websocket: WebSocket) -> Optional[str]:
     Returns:
         The API token string or None if not found.
     """
-    auth = websocket.headers.get("authorization") or websocket.headers.get("Authorization")
-    if auth and auth.lower().startswith("bearer "):
-        return auth.split(" ", 1)[1]
+    # Starlette Headers lookups are case-insensitive already
+    token = _bearer_token(websocket.headers.get("authorization"))
+    if token:
+        return token
     
     return websocket.headers.get("x-api-token")
 
@@ -79,13 +205,16 @@ async def _wait_for_auth_message(
     """
     try:
         raw_data = await asyncio.wait_for(
-            websocket.receive_text(),
+            _receive_packet(websocket),
             timeout=timeout
         )
         
         try:
-            message = json.loads(raw_data)
-        except json.JSONDecodeError:
+            message = orjson.loads(raw_data)
+        except orjson.JSONDecodeError:
+            return False, None, None
+        
+        if not isinstance(message, dict):
             return False, None, None
         
         # Check if this is an auth message
@@ -107,7 +236,7 @@ async def _authenticate_websocket_device(
     websocket: WebSocket,
     device_id: str,
     api_token: str
-) -> tuple[bool, Optional[object], Optional[object], Session]:
+) -> tuple[bool, Optional[object], Optional[object]]:
     """Authenticate device WebSocket connection via API token and device_id.
     
     Authentication flow:
@@ -123,44 +252,46 @@ async def _authenticate_websocket_device(
         api_token: The API token from Authorization header.
         
     Returns:
-        Tuple of (success, user, device, db_session).
+        Tuple of (success, user, device) as cached read-only tuples. The
+        (async) DB session is only opened on a cache miss and is closed
+        before returning, so a long-lived connection never keeps a pooled
+        DB connection checked out.
     """
-    db = next(get_db())
     await websocket.accept()
     
-    # Validate API token (user authentication)
-    user = validate_api_token(db, api_token)
+    # Reconnects of a known device resolve both checks from the token cache
+    user = peek_api_user(api_token)
+    device = peek_owned_device(device_id, user.id) if user else None
+    if device is None:
+        # Cache miss: async session, so the lookup never blocks the event loop
+        async with AsyncSessionLocal() as db:
+            # Validate API token (user authentication)
+            if user is None:
+                user = await db.run_sync(get_api_user, api_token)
+            # Get device and verify ownership (prebuilt Core select)
+            if user:
+                device = await db.run_sync(get_owned_device, device_id, user.id)
     
     if not user:
-        await websocket.send_json({
-            "status": "error",
-            "error": "INVALID_API_TOKEN",
-            "message": "Invalid API token"
-        })
+        await _send_json(websocket, INVALID_API_TOKEN_FRAME)
         await websocket.close(code=1008, reason="Invalid API token")
-        return False, None, None, db
-    
-    # Get device and verify ownership
-    device = db.query(Device).filter(
-        Device.device_id == device_id,
-        Device.user_id == user.id
-    ).first()
+        return False, None, None
     
     if not device:
-        await websocket.send_json({
+        await _send_json(websocket, {
             "status": "error",
             "error": "DEVICE_NOT_FOUND",
             "message": f"Device {device_id} not found or not owned by user"
         })
         await websocket.close(code=1008, reason="Device not found")
-        return False, None, None, db
+        return False, None, None
     
-    return True, user, device, db
+    return True, user, device
 
 
 async def _authenticate_websocket(
     websocket: WebSocket
-) -> tuple[bool, Optional[object], Session, Optional[dict]]:
+) -> tuple[bool, Optional[object], Optional[dict]]:
     """Authenticate WebSocket connection via JSON auth message.
     
     Authentication flow:
@@ -175,10 +306,11 @@ async def _authenticate_websocket(
         websocket: The WebSocket connection.
         
     Returns:
-        Tuple of (success, user, db_session, first_data_message).
+        Tuple of (success, user, first_data_message).
         first_data_message is non-None if client sent data instead of auth (legacy).
+        A DB session is opened only on a token cache miss, never while
+        waiting for the auth message.
     """
-    db = next(get_db())
     await websocket.accept()
     
     # First, try to get token from headers (backwards compatibility)
@@ -199,25 +331,21 @@ async def _authenticate_websocket(
         logger.debug("[WSS] Auth via headers (legacy)")
     
     if not token:
-        await websocket.send_json({
-            "status": "error",
-            "error": "AUTH_REQUIRED",
-            "message": "Authentication required. Send: {\"type\": \"auth\", \"token\": \"<api_token>\"}"
-        })
+        await _send_json(websocket, AUTH_MESSAGE_REQUIRED_FRAME)
         await websocket.close(code=1008)
-        return False, None, db, None
+        return False, None, None
     
-    user = validate_api_token(db, token)
+    # Reconnect storms hit the token cache without opening a DB session
+    user = peek_api_user(token)
+    if user is None:
+        async with AsyncSessionLocal() as db:
+            user = await db.run_sync(get_api_user, token)
     if not user:
-        await websocket.send_json({
-            "status": "error",
-            "error": "INVALID_TOKEN",
-            "message": "Invalid API token"
-        })
+        await _send_json(websocket, INVALID_TOKEN_FRAME)
         await websocket.close(code=1008)
-        return False, None, db, None
+        return False, None, None
     
-    return True, user, db, first_message
+    return True, user, first_message
 
 
 @router.websocket("/ws/{device_id}")
@@ -259,135 +387,120 @@ async def websocket_device_endpoint(
         device_id: Device identifier from URL path.
     """
     # Extract API token from Authorization header
-    auth_header = websocket.headers.get("authorization", "")
-    api_token = None
-    
-    if auth_header.lower().startswith("bearer "):
-        api_token = auth_header[7:]  # Remove "Bearer " prefix
+    api_token = _bearer_token(websocket.headers.get("authorization"))
     
     if not api_token:
         await websocket.accept()
-        await websocket.send_json({
-            "status": "error",
-            "error": "AUTH_REQUIRED",
-            "message": "Authorization header with Bearer token is required"
-        })
+        await _send_json(websocket, AUTH_HEADER_REQUIRED_FRAME)
         await websocket.close(code=1008, reason="Missing Authorization header")
         return
     
     # Authenticate user and verify device ownership
-    success, user, device, db = await _authenticate_websocket_device(
+    success, user, device = await _authenticate_websocket_device(
         websocket, device_id, api_token
     )
     
     if not success:
         return
     
-    # Update device last_seen on connect
-    device.last_seen = datetime.now().astimezone()
-    db.commit()
+    # Update device last_seen on connect (written behind, batched)
+    last_seen_tracker.touch(device_id)
     
     # Register in relay for command delivery
     await relay.connect(websocket, device_id, already_accepted=True)
     logger.info(f"[WSS] Device {device_id} connected for user {user.username}")
     
     try:
-        await websocket.send_json({
-            "type": "welcome",
-            "status": "connected",
-            "device_id": device_id,
-            "protocol_version": "1.0",
-            "message": "WebSocket connection established"
-        })
+        await _send_json(websocket, DEVICE_WELCOME_TEMPLATE % orjson.dumps(device_id).decode())
         
         logger.info(f"[WSS] Welcome sent to {device_id}")
         
+        # Hot-loop callables bound once per connection (LOAD_FAST per packet)
+        loads = orjson.loads
+        decode_error = orjson.JSONDecodeError
+        touch = last_seen_tracker.touch
+        set_request_counter = last_seen_tracker.set_request_counter
+        push_response = relay.push_response
+        queue_message = message_writer.add
+        
         # Keep connection alive - listen for messages from device
         # Device can send responses at any time
         while True:
             try:
-                raw_data = await asyncio.wait_for(
-                    websocket.receive_text(),
-                    timeout=None  # No timeout - device can be idle
-                )
-            except asyncio.TimeoutError:
-                # This won't happen with timeout=None, but handles gracefully
-                logger.warning(f"[WSS] Timeout waiting for data from {device_id}")
-                continue
+                # No timeout - device can be idle (pings keep the socket alive)
+                raw_data = await _receive_packet(websocket)
             except Exception as e:
                 # Connection closed or other error
                 logger.debug(f"[WSS] Device {device_id} connection error: {e}")
                 break
             
             try:
-                message_data = json.loads(raw_data)
-            except json.JSONDecodeError:
+                message_data = loads(raw_data)
+            except decode_error:
                 logger.warning(f"[WSS] Invalid JSON from device {device_id}")
-                await websocket.send_json({
-                    "status": "error",
-                    "error": "INVALID_JSON",
-                    "message": "Failed to parse JSON"
-                })
+                await _send_json(websocket, DEVICE_INVALID_JSON_FRAME)
                 continue
             
             # Check for required fields (encrypted packet)
-            required_fields = ["device_id", "payload", "signature", "version"]
-            missing = [f for f in required_fields if f not in message_data]
+            missing = _missing_fields(message_data)
             if missing:
                 logger.warning(f"[WSS] Invalid packet from device {device_id}, missing: {missing}")
-                await websocket.send_json({
+                await _send_json(websocket, {
                     "status": "error",
                     "error": "INVALID_PACKET",
                     "message": f"Missing fields: {missing}"
                 })
                 continue
             
-            if message_data.get("version") != "1.0":
+            get = message_data.get
+            if get("version") != "1.0":
                 logger.warning(f"[WSS] Unsupported version from device {device_id}")
-                await websocket.send_json({
-                    "status": "error",
-                    "error": "UNSUPPORTED_VERSION",
-                    "message": "Protocol version must be 1.0"
-                })
+                await _send_json(websocket, DEVICE_UNSUPPORTED_VERSION_FRAME)
                 continue
             
-            # Update device last_seen and request_counter
-            target_device_id = message_data.get("device_id")
-            device_record = db.query(Device).filter(Device.device_id == target_device_id).first()
-            if device_record:
-                device_record.last_seen = datetime.now().astimezone()
-                if message_data.get("request_counter") is not None:
-                    device_record.last_request_counter = message_data.get("request_counter")
-                db.commit()
-                logger.debug(f"[WSS] Device {target_device_id} last_seen updated")
+            if not _has_string_fields(message_data):
+                logger.warning(f"[WSS] Invalid field types from device {device_id}")
+                await _send_json(websocket, INVALID_FIELD_TYPES_FRAME)
+                continue
+            
+            # Update device last_seen and request_counter (written behind, batched;
+            # an unknown device_id simply matches no row)
+            target_device_id = get("device_id")
+            request_counter = get("request_counter")
+            touch(target_device_id)
+            if request_counter is not None and not set_request_counter(target_device_id, request_counter):
+                # Not a 64-bit int: still relayed, but never written to the DB
+                logger.warning(f"[WSS] Invalid request_counter from device {device_id}")
             
             # This is a RESPONSE from device (since device is sending it)
-            # Forward to the client that's waiting
-            outer_packet = {
-                "device_id": target_device_id,
-                "payload": message_data.get("payload"),
-                "signature": message_data.get("signature"),
-                "request_counter": message_data.get("request_counter"),
-                "version": "1.0"
-            }
+            # Forward to the client that's waiting. Blind relay: a frame that
+            # already is a v1.0 outer packet goes out as received, without a
+            # re-encode; anything else is normalized to that shape.
+            if message_data.keys() == RESPONSE_FIELDS:
+                outer_packet = raw_data if isinstance(raw_data, str) else raw_data.decode()
+            else:
+                outer_packet = {
+                    "device_id": target_device_id,
+                    "payload": get("payload"),
+                    "signature": get("signature"),
+                    "request_counter": request_counter,
+                    "version": "1.0"
+                }
             
             # Try to forward to waiting client
-            forwarded = await relay.push_response(device_id, outer_packet)
+            forwarded = await push_response(device_id, outer_packet)
             
             if forwarded:
                 logger.info(f"[WSS] Device {device_id} response forwarded to client")
             else:
-                # No client waiting - store in DB for HTTP polling
-                msg = Message(
+                # No client waiting - store in DB for HTTP polling (batched)
+                queue_message(
                     device_id=target_device_id,
-                    device_token=device.device_token if device else None,
                     message_type="response",
-                    message_data=message_data.get("payload", ""),
-                    signature=message_data.get("signature", ""),
+                    message_data=get("payload", ""),
+                    signature=get("signature", ""),
                     direction="to_client"
                 )
-                db.add(msg)
-                db.commit()
                 logger.info(f"[WSS] Device {device_id} response queued for HTTP")
     
     except WebSocketDisconnect:
@@ -425,7 +538,7 @@ async def websocket_client_endpoint(
         websocket: The WebSocket connection.
         client_id: Unique client identifier.
     """
-    success, user, db, first_message = await _authenticate_websocket(websocket)
+    success, user, first_message = await _authenticate_websocket(websocket)
     
     if not success:
         return
@@ -435,13 +548,7 @@ async def websocket_client_endpoint(
     logger.info(f"[WSS] Client connected: {client_id} user={user.username}")
     
     try:
-        await websocket.send_json({
-            "type": "welcome",
-            "status": "connected",
-            "client_id": client_id,
-            "protocol_version": "1.0",
-            "message": "Client WebSocket connection established"
-        })
+        await _send_json(websocket, CLIENT_WELCOME_TEMPLATE % orjson.dumps(client_id).decode())
         
         # Process first message if it was received during auth (legacy client)
         pending_message = first_message
@@ -450,22 +557,19 @@ async def websocket_client_endpoint(
             if pending_message:
                 message_data = pending_message
                 pending_message = None
+                raw_data = None  # Parsed during auth, no frame text kept
             else:
-                raw_data = await websocket.receive_text()
+                raw_data = await _receive_packet(websocket)
                 
                 try:
-                    message_data = json.loads(raw_data)
-                except json.JSONDecodeError:
-                    await websocket.send_json({
-                        "status": "error",
-                        "error": "INVALID_JSON"
-                    })
+                    message_data = orjson.loads(raw_data)
+                except orjson.JSONDecodeError:
+                    await _send_json(websocket, CLIENT_INVALID_JSON_FRAME)
                     continue
             
-            required_fields = ["device_id", "payload", "signature", "version"]
-            missing = [f for f in required_fields if f not in message_data]
+            missing = _missing_fields(message_data)
             if missing:
-                await websocket.send_json({
+                await _send_json(websocket, {
                     "status": "error",
                     "error": "INVALID_PACKET",
                     "message": f"Missing: {missing}"
@@ -473,52 +577,47 @@ async def websocket_client_endpoint(
                 continue
             
             if message_data.get("version") != "1.0":
-                await websocket.send_json({
-                    "status": "error",
-                    "error": "UNSUPPORTED_VERSION"
-                })
+                await _send_json(websocket, CLIENT_UNSUPPORTED_VERSION_FRAME)
+                continue
+            
+            if not _has_string_fields(message_data):
+                await _send_json(websocket, INVALID_FIELD_TYPES_FRAME)
                 continue
             
             target_device_id = message_data.get("device_id")
             
-            # Update device last_seen
-            device = db.query(Device).filter(Device.device_id == target_device_id).first()
-            if device:
-                device.last_seen = datetime.now().astimezone()
-                db.commit()
+            # Update device last_seen (written behind, batched; an unknown
+            # device_id simply matches no row, so no SELECT per command)
+            last_seen_tracker.touch(target_device_id)
             
-            # Build command packet to send to device
-            outer_packet = {
-                "device_id": target_device_id,
-                "payload": message_data.get("payload"),
-                "signature": message_data.get("signature"),
-                "version": "1.0"
-            }
+            # Build command packet to send to device. A frame that already is
+            # exactly the v1.0 outer packet is relayed as received.
+            if raw_data is not None and message_data.keys() == REQUIRED_FIELDS:
+                outer_packet = raw_data if isinstance(raw_data, str) else raw_data.decode()
+            else:
+                outer_packet = {
+                    "device_id": target_device_id,
+                    "payload": message_data.get("payload"),
+                    "signature": message_data.get("signature"),
+                    "version": "1.0"
+                }
             
             # Push to device, tracking that this client wants the response
             delivered = await relay.push(target_device_id, outer_packet, sender_id=connection_id)
             
             if not delivered:
-                # Device offline - store command in DB
-                msg = Message(
+                # Device offline - store command in DB (batched)
+                message_writer.add(
                     device_id=target_device_id,
-                    device_token=device.device_token if device else None,
                     message_type="command",
                     message_data=message_data.get("payload", ""),
                     signature=message_data.get("signature", ""),
                     direction="to_device"
                 )
-                db.add(msg)
-                db.commit()
             
-            # Send ACK to client
-            await websocket.send_json({
-                "status": "success",
-                "device_id": target_device_id,
-                "delivered": delivered,
-                "queued": not delivered,
-                "message": "Delivered to device" if delivered else "Device offline, queued"
-            })
+            # Send ACK to client (prebuilt frame, only the device_id is encoded)
+            ack_template = CLIENT_DELIVERED_ACK_TEMPLATE if delivered else CLIENT_QUEUED_ACK_TEMPLATE
+            await _send_json(websocket, ack_template % orjson.dumps(target_device_id).decode())
             
             logger.debug(f"[WSS] Client {client_id} -> {target_device_id} delivered={delivered}")
     
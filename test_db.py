@@ -7,6 +7,8 @@ from pathlib import Path
 # Add server to path
 sys.path.insert(0, str(Path(__file__).parent))
 
+from sqlalchemy import select
+
 from core.database import SessionLocal
 from core.models import User, Device
 from core.config import settings
@@ -20,13 +22,16 @@ def main():
     db = SessionLocal()
     
     try:
-        users = db.query(User).all()
+        # Only the printed columns, as Row tuples (no ORM objects)
+        users = db.execute(select(User.username, User.api_token)).all()
         print(f"Total users: {len(users)}")
         for user in users:
             print(f"  - {user.username} (API Token: {user.api_token[:16]}...)")
         
         print()
-        devices = db.query(Device).all()
+        devices = db.execute(
+            select(Device.device_id, Device.device_token, Device.user_id, Device.last_seen)
+        ).all()
         print(f"Total devices: {len(devices)}")
         for device in devices:
             print(f"  - {device.device_id} (Token: {device.device_token[:16]}...)")